@@ -1,310 +1,605 @@
-from dash import Dash, html, dcc, Input, Output, State, ctx
+import gzip
+import itertools
+import os
+import threading
+from dash import Dash, html, dcc, Input, Output, State, ctx, Patch, no_update, clientside_callback
 import dash_bootstrap_components as dbc
-import pandas as pd
-from src.model import train_models
-from src.etl import prepare_patient_data_with_names, categorizar_edad, load_data
-from src.graphics import create_gauge_chart, plot_feature_importance, plot_heatmap, plot_histogram_with_patient, plot_risk_distribution, plot_age_distribution
+from flask import Response, has_request_context, request, stream_with_context
+from src.model import get_models, explain_risk, predict_risk, memory_usage_mb, start_model_watcher
+from src.figure_cache import figure_cache
+from src import metrics
+from src.tasks import task_pool
+from src.batch import iter_csv_chunks, iter_record_chunks, missing_columns, records_error, stream_csv, stream_ndjson
+from src.etl import get_datasets, correlation_from_moments, sketch_values
+from src.features import FEATURES, FEATURE_LABELS, model_inputs, patient_record
+from src.ingest import (population_sketch, population_summary, population_version, record_submission, risk_percentile,
+                        risk_population, risk_population_version, start_ingest_thread)
+from src.graphics import (create_gauge_chart, plot_feature_importance, plot_correlation_heatmap, plot_histogram_base, plot_risk_distribution_base,
+                          plot_age_distribution_base, patient_overlay, risk_patient_name, PATIENT_TRACE)
+
+try:
+    import brotli
+except ImportError:  # sin brotli se comprime con gzip
+    brotli = None
 
 # Inicializar la aplicación Dash 
 app = Dash(__name__, title="AppHealth", external_stylesheets=[dbc.themes.BOOTSTRAP])
 # Declare server for Heroku deployment. Needed for Procfile.
 server = app.server
 
-# Entrenar los modelos
-models = train_models()
-diabetes_model, diabetes_accuracy = models['diabetes']
-hypertension_model, hypertension_accuracy = models['hypertension']
-
-# Diseño de la aplicación
-app.layout = dbc.Container(
-    fluid=True,  # Para que ocupe toda la página
-    style={'backgroundColor': '#FAEBD7', 'padding': '20px'},
-    children=[
-        dcc.Store(id='prepared-patient-diabetes-store'),
-        dcc.Store(id='prepared-patient-hypertension-store'),
-        html.H1(
-            "Bienvenido a tu Detector de Enfermedades de Confianza",
-            style={'textAlign': 'center', 'color': '#444',"text-decoration": "underline"}
-        ),
+# Gráficos adicionales que se pueden seleccionar
+ADDITIONAL_GRAPHS = ['risk_diabetes', 'risk_hypertension', 'bmi_distribution', 'age_distribution', 'heart_rate_distribution']
+
+# Petición a la caché compartida: clave (gráfico, versión de datos, versión de modelo, tamaño)
+# y función que construye la figura la primera vez
+def figure_request(chart, data_version, model_version, size, build):
+    def build_sized():
+        fig = build()
+        if size is not None:
+            fig.update_layout(height=size[0], width=size[1])
+        return fig
+    return (chart, data_version, model_version, size), build_sized
+
+# Figura desde la caché compartida; solo se construye la primera vez
+def cached_figure(chart, data_version, model_version, size, build):
+    return figure_cache.get(*figure_request(chart, data_version, model_version, size, build))
+
+# Gráficos de importancia de variables y heatmaps, servidos desde la caché; cada envío
+# solo los hace visibles. La importancia sale del informe calculado al entrenar
+# (src.model.build_model_report) y la correlación de los momentos de la población
+# (conjunto de datos más pacientes ingeridos, src.ingest), así que sigue al día sin recorrerla
+def importance_heatmap_graphs(models):
+    diabetes_report = models['diabetes']['report']
+    feature_importance_diabetes = cached_figure(
+        'feature_importance:diabetes', None, models['diabetes']['version'], (400, 600),
+        lambda: plot_feature_importance(diabetes_report['features'], diabetes_report['feature_importances'], title="Importancia de las Variables para Diabetes"))
+    hypertension_report = models['hypertension']['report']
+    feature_importance_hypertension = cached_figure(
+        'feature_importance:hypertension', None, models['hypertension']['version'], (400, 600),
+        lambda: plot_feature_importance(hypertension_report['features'], hypertension_report['feature_importances'], title="Importancia de las Variables para Hipertensión"))
+
+    heatmap_diabetes = cached_figure(
+        'heatmap:diabetes', population_version('diabetes'), None, (500, 600),
+        lambda: plot_correlation_heatmap(correlation_from_moments(population_sketch('diabetes')['moments']),
+                                         FEATURES['diabetes'], "Heatmap de Variables para Diabetes"))
+    heatmap_hypertension = cached_figure(
+        'heatmap:hypertension', population_version('hypertension'), None, (500, 600),
+        lambda: plot_correlation_heatmap(correlation_from_moments(population_sketch('hypertension')['moments']),
+                                         FEATURES['hypertension'], "Heatmap de Variables para Hipertensión"))
+
+    # Gráficos alineados en filas y columnas
+    return [
         dbc.Row(
             [
-                # Formulario inicial
-                dbc.Col(
-                    style={
-                        'backgroundColor': '#FFAB91',
-                        'padding': '20px',
-                        'borderRadius': '10px',
-                        'marginRight': '10px'
-                    },
-                    width=4, 
-                    children=[
-                        html.Label("1- Introduzca su Edad:"),
-                        dcc.Input(id='age-input', type='number', placeholder='Edad (mayor de 18 años)', style={
-                            'width': '100%', 'padding': '10px', 'marginBottom': '20px', 'borderRadius': '5px'}),
-                        html.Div(
-                            children=[
-                                html.Label("2- Introduzca su BMI (Índice de Masa Corporal):"),
-                                html.Div(
-                                    children=[
-                                        html.Span("BMI = ", style={'fontWeight': 'bold', 'color': '#444'}),
-                                        html.Span("Peso corporal [kg] ", style={'fontWeight': 'bold', 'color': '#444'}),
-                                        html.Span("/ Altura", style={'fontWeight': 'bold', 'color': '#444'}),
-                                        html.Span("² [m²]", style={'fontWeight': 'bold', 'color': '#444'})
-                                    ],
-                                    style={'fontSize': '16px', 'marginBottom': '10px'}
-                                ),
-                                dcc.Input(id='bmi-input', type='number', placeholder='BMI', style={
-                                    'width': '100%', 'padding': '10px', 'marginBottom': '20px', 'borderRadius': '5px'})
-                            ],
-                            style={'marginBottom': '10px'}
-                        ),
-                        html.Div(
-                            children=[
-                                html.Label("3- En general, su salud es (1 Excelente, 5 Horrible):"),
-                                dcc.Slider(id='health-slider', min=1, max=5, step=1,
-                                        marks={i: str(i) for i in range(1, 6)}, value=3,
-                                        tooltip={"placement": "bottom"})
-                                ],
-                            style={'marginBottom': '20px'}
-                        ),
-                        html.Label("4- Indique qué tipo de dolor de pecho ha experimentado:"),
-                        dcc.RadioItems(id='chest-pain-radio', options=[
-                            {'label': 'No siento dolor', 'value': 0},
-                            {'label': 'Dolor no relacionado con angina: Es un dolor que no parece estar relacionado con el corazón. Puede ser un dolor muscular o de otra naturaleza (como dolor que aumenta al tocar el área o con ciertos movimientos).', 'value': 3},
-                            {'label': 'Dolor atípico de angina: Es un dolor en el pecho que no sigue un patrón claro, no siempre ocurre con esfuerzo ni siempre se alivia con descanso.', 'value': 1},
-                            {'label': 'Dolor típico de angina: Sensación de presión en el pecho que ocurre cuando hace algún esfuerzo físico o está bajo estrés, y suele aliviarse cuando descansa.', 'value': 2}
-                        ], value=0, style={'marginBottom': '20px'}),
-                        html.Label("5- ¿Siente algun dolor u opresión en el pecho al realizar ejercicio físico?"),
-                        html.Label("(0: Siente un dolor o una fuerte opresión que me obliga a detenerme por completo. / 6: No siente ningún dolor u opresión durante el ejercicio)"),
-                        dcc.Slider(id='pain-slider', min=0, max=6, step=0.1,
-                                   marks={i: str(i) for i in range(7)}, value=3,
-                                   tooltip={"placement": "bottom"}),
-                        html.Div(
-                            style={'textAlign': 'center', 'marginTop': '10px'},
-                            children=[
-                                html.Button("Mostrar resultados", id='submit-button',
-                                            style={'backgroundColor': '#FF7043', 'color': 'white',
-                                                   'border': 'none', 'padding': '10px 20px',
-                                                   'borderRadius': '5px', 'cursor': 'pointer'})
-                            ]
-                        )
-                    ]
-                ),
-                # Gráficos gauge
-                dbc.Col(
-                    id='results-container',
-                    style={
-                        'backgroundColor': '#FFFFFF',
-                        'padding': '10px',
-                        'borderRadius': '10px',
-                    },
-                    width=7
-                )
+                dbc.Col(dcc.Graph(figure=feature_importance_diabetes), width=6, style={'textAlign': 'center'}),
+                dbc.Col(dcc.Graph(figure=feature_importance_hypertension), width=6, style={'textAlign': 'center'})
             ],
             justify='center'
         ),
-        html.Hr(),
-        # Gráficos de importancia de variables y heatmaps
-        html.Div(
-            id='importance-heatmap-container',
-            style={'backgroundColor': '#FFFFFF', 'padding': '30px', 'borderRadius': '10px', 'marginTop': '20px', 'marginBottom': '20px', 'marginRight': '60px', 'marginLeft': '60px'},
-            children=[]
-        ),
-        html.Hr(),
-        # Selector de gráficos adicionales 
         dbc.Row(
             [
-                dbc.Col(
-                    style={
-                        'backgroundColor': '#FFAB91',
-                        'padding': '20px',
-                        'borderRadius': '10px',
-                        'marginRight': '10px'
-                    },
-                    width=4,
-                    children=[
-                        html.Label("Seleccione los gráficos adicionales que desea visualizar:"),
-                        dcc.Checklist(
-                            id='additional-graphs-checklist',
-                            options=[
-                                {'label': 'Distribución del riesgo de Diabetes', 'value': 'risk_diabetes'},
-                                {'label': 'Distribución del riesgo de Hipertensión', 'value': 'risk_hypertension'},
-                                {'label': 'Distribución de BMI', 'value': 'bmi_distribution'},
-                                {'label': 'Distribución de la Edad', 'value': 'age_distribution'},
-                                {'label': 'Distribución de la Frecuencia Cardíaca Máxima', 'value': 'heart_rate_distribution'}
-                            ],
-                            value=[],
-                            style={'marginBottom': '20px', 'display': 'inline-block', 'textAlign': 'left'}
-                        ),
-                        html.Div(
-                            style={'textAlign': 'center', 'marginTop': '20px'},
-                            children=[
-                                html.Button("Mostrar gráficos seleccionados", id='show-graphs-button',
-                                            style={'backgroundColor': '#FF7043', 'color': 'white',
-                                                'border': 'none', 'padding': '10px 20px',
-                                                'borderRadius': '5px', 'cursor': 'pointer'})
-                            ]
-                        )
-                    ]
-                ),
-                # Mostrar los gráficos seleccionados
-                dbc.Col(
-                    id='additional-graphs-container',
-                    style={
-                        'backgroundColor': '#FFFFFF',
-                        'padding': '10px',
-                        'borderRadius': '10px',
-                    },
-                    width=7
-                )
+                dbc.Col(dcc.Graph(figure=heatmap_diabetes), width=6, style={'textAlign': 'center'}),
+                dbc.Col(dcc.Graph(figure=heatmap_hypertension), width=6, style={'textAlign': 'center'})
             ],
             justify='center'
         )
-
     ]
-)
+
+# Los modelos ya entrenados (python -m src.train) y los datasets no se cargan al importar
+# la app sino en warm_up(): gunicorn la llama al arrancar (gunicorn.conf.py) y el
+# servidor de desarrollo antes de atender (python app.py). /ready responde 503 hasta entonces
+ready = threading.Event()
+
+def warm_up():
+    get_datasets()
+    importance_heatmap_graphs(get_models())
+    ready.set()
+
+# Antes de servir una versión nueva de un modelo (src.model.refresh_models) se construyen
+# sus figuras, así que el cambio no se nota en la latencia. Las figuras de la versión
+# anterior no se borran: su clave incluye la versión y la caché LRU las acaba expulsando
+def prepare_models(models):
+    importance_heatmap_graphs(models)
+    figure_cache.get_many({name: additional_graph_base(name, models) for name in ('risk_diabetes', 'risk_hypertension')})
+
+# Consultar el registro de modelos en este proceso (gunicorn lo llama en cada worker)
+def watch_models(log=print):
+    return start_model_watcher(prepare_models, log)
+
+# Diseño de la aplicación. Es una función para que importar la app no obligue a cargar los modelos;
+# Dash también la llama al asignarla para validar los ids, y esa llamada (sin petición) no construye figuras
+def serve_layout():
+    return dbc.Container(
+        fluid=True,  # Para que ocupe toda la página
+        style={'backgroundColor': '#FAEBD7', 'padding': '20px'},
+        children=[
+            # Registro compacto del paciente (src.features.patient_record): datos del formulario,
+            # variables derivadas y probabilidades; los gauges se pintan en el navegador a partir de él.
+            # 'ingested' indica si ya se ha guardado en la población (src.ingest.record_submission)
+            dcc.Store(id='patient-store'),
+            # Versión de la base de población que ya tiene el navegador en cada gráfico adicional
+            dcc.Store(id='additional-graphs-versions'),
+            html.H1(
+                "Bienvenido a tu Detector de Enfermedades de Confianza",
+                style={'textAlign': 'center', 'color': '#444',"text-decoration": "underline"}
+            ),
+            dbc.Row(
+                [
+                    # Formulario inicial
+                    dbc.Col(
+                        style={
+                            'backgroundColor': '#FFAB91',
+                            'padding': '20px',
+                            'borderRadius': '10px',
+                            'marginRight': '10px'
+                        },
+                        width=4, 
+                        children=[
+                            html.Label("1- Introduzca su Edad:"),
+                            dcc.Input(id='age-input', type='number', placeholder='Edad (mayor de 18 años)', style={
+                                'width': '100%', 'padding': '10px', 'marginBottom': '20px', 'borderRadius': '5px'}),
+                            html.Div(
+                                children=[
+                                    html.Label("2- Introduzca su BMI (Índice de Masa Corporal):"),
+                                    html.Div(
+                                        children=[
+                                            html.Span("BMI = ", style={'fontWeight': 'bold', 'color': '#444'}),
+                                            html.Span("Peso corporal [kg] ", style={'fontWeight': 'bold', 'color': '#444'}),
+                                            html.Span("/ Altura", style={'fontWeight': 'bold', 'color': '#444'}),
+                                            html.Span("² [m²]", style={'fontWeight': 'bold', 'color': '#444'})
+                                        ],
+                                        style={'fontSize': '16px', 'marginBottom': '10px'}
+                                    ),
+                                    dcc.Input(id='bmi-input', type='number', placeholder='BMI', style={
+                                        'width': '100%', 'padding': '10px', 'marginBottom': '20px', 'borderRadius': '5px'})
+                                ],
+                                style={'marginBottom': '10px'}
+                            ),
+                            html.Div(
+                                children=[
+                                    html.Label("3- En general, su salud es (1 Excelente, 5 Horrible):"),
+                                    dcc.Slider(id='health-slider', min=1, max=5, step=1,
+                                            marks={i: str(i) for i in range(1, 6)}, value=3,
+                                            tooltip={"placement": "bottom"})
+                                    ],
+                                style={'marginBottom': '20px'}
+                            ),
+                            html.Label("4- Indique qué tipo de dolor de pecho ha experimentado:"),
+                            dcc.RadioItems(id='chest-pain-radio', options=[
+                                {'label': 'No siento dolor', 'value': 0},
+                                {'label': 'Dolor no relacionado con angina: Es un dolor que no parece estar relacionado con el corazón. Puede ser un dolor muscular o de otra naturaleza (como dolor que aumenta al tocar el área o con ciertos movimientos).', 'value': 3},
+                                {'label': 'Dolor atípico de angina: Es un dolor en el pecho que no sigue un patrón claro, no siempre ocurre con esfuerzo ni siempre se alivia con descanso.', 'value': 1},
+                                {'label': 'Dolor típico de angina: Sensación de presión en el pecho que ocurre cuando hace algún esfuerzo físico o está bajo estrés, y suele aliviarse cuando descansa.', 'value': 2}
+                            ], value=0, style={'marginBottom': '20px'}),
+                            html.Label("5- ¿Siente algun dolor u opresión en el pecho al realizar ejercicio físico?"),
+                            html.Label("(0: Siente un dolor o una fuerte opresión que me obliga a detenerme por completo. / 6: No siente ningún dolor u opresión durante el ejercicio)"),
+                            dcc.Slider(id='pain-slider', min=0, max=6, step=0.1,
+                                       marks={i: str(i) for i in range(7)}, value=3,
+                                       tooltip={"placement": "bottom"}),
+                            # Solo se guardan (de forma anónima, src.ingest) los datos de quien lo acepta
+                            dcc.Checklist(id='consent-input', options=[
+                                {'label': ' Acepto que mis respuestas se guarden de forma anónima para mejorar las estadísticas de la población', 'value': 'yes'}
+                            ], value=[], style={'marginTop': '20px'}),
+                            html.Div(
+                                style={'textAlign': 'center', 'marginTop': '10px'},
+                                children=[
+                                    html.Button("Mostrar resultados", id='submit-button',
+                                                style={'backgroundColor': '#FF7043', 'color': 'white',
+                                                       'border': 'none', 'padding': '10px 20px',
+                                                       'borderRadius': '5px', 'cursor': 'pointer'})
+                                ]
+                            )
+                        ]
+                    ),
+                    # Gráficos gauge
+                    dbc.Col(
+                        id='results-container',
+                        style={
+                            'backgroundColor': '#FFFFFF',
+                            'padding': '10px',
+                            'borderRadius': '10px',
+                        },
+                        width=7,
+                        children=[
+                            html.Div(id='results-message'),
+                            html.Div(
+                                id='gauges-wrapper',
+                                style={'display': 'none'},
+                                children=[
+                                    dbc.Row(
+                                        [
+                                            dbc.Col(dcc.Graph(id='gauge-diabetes', figure=cached_figure('gauge:diabetes', None, None, None, lambda: create_gauge_chart(0, "Nivel de Riesgo Diabetes"))), width=9, style={'textAlign': 'center'}),
+                                            dbc.Col(html.Div(id='explanation-diabetes'), width=9)
+                                        ],
+                                        justify='center'
+                                    ),
+                                    dbc.Row(
+                                        [
+                                            dbc.Col(dcc.Graph(id='gauge-hypertension', figure=cached_figure('gauge:hypertension', None, None, None, lambda: create_gauge_chart(0, "Nivel de Riesgo Hipertensión"))), width=9, style={'textAlign': 'center'}),
+                                            dbc.Col(html.Div(id='explanation-hypertension'), width=9)
+                                        ],
+                                        justify='center'
+                                    )
+                                ]
+                            )
+                        ]
+                    )
+                ],
+                justify='center'
+            ),
+            html.Hr(),
+            # Gráficos de importancia de variables y heatmaps
+            html.Div(
+                id='importance-heatmap-container',
+                style={'backgroundColor': '#FFFFFF', 'padding': '30px', 'borderRadius': '10px', 'marginTop': '20px', 'marginBottom': '20px', 'marginRight': '60px', 'marginLeft': '60px'},
+                children=html.Div(id='importance-heatmap-wrapper', style={'display': 'none'}, children=importance_heatmap_graphs(get_models()) if has_request_context() else [])
+            ),
+            html.Hr(),
+            # Selector de gráficos adicionales 
+            dbc.Row(
+                [
+                    dbc.Col(
+                        style={
+                            'backgroundColor': '#FFAB91',
+                            'padding': '20px',
+                            'borderRadius': '10px',
+                            'marginRight': '10px'
+                        },
+                        width=4,
+                        children=[
+                            html.Label("Seleccione los gráficos adicionales que desea visualizar:"),
+                            dcc.Checklist(
+                                id='additional-graphs-checklist',
+                                options=[
+                                    {'label': 'Distribución del riesgo de Diabetes', 'value': 'risk_diabetes'},
+                                    {'label': 'Distribución del riesgo de Hipertensión', 'value': 'risk_hypertension'},
+                                    {'label': 'Distribución de BMI', 'value': 'bmi_distribution'},
+                                    {'label': 'Distribución de la Edad', 'value': 'age_distribution'},
+                                    {'label': 'Distribución de la Frecuencia Cardíaca Máxima', 'value': 'heart_rate_distribution'}
+                                ],
+                                value=[],
+                                style={'marginBottom': '20px', 'display': 'inline-block', 'textAlign': 'left'}
+                            ),
+                            html.Div(
+                                style={'textAlign': 'center', 'marginTop': '20px'},
+                                children=[
+                                    html.Button("Mostrar gráficos seleccionados", id='show-graphs-button',
+                                                style={'backgroundColor': '#FF7043', 'color': 'white',
+                                                    'border': 'none', 'padding': '10px 20px',
+                                                    'borderRadius': '5px', 'cursor': 'pointer'})
+                                ]
+                            )
+                        ]
+                    ),
+                    # Mostrar los gráficos seleccionados
+                    dbc.Col(
+                        id='additional-graphs-container',
+                        style={
+                            'backgroundColor': '#FFFFFF',
+                            'padding': '10px',
+                            'borderRadius': '10px',
+                        },
+                        width=7,
+                        # Indicador de carga mientras se construyen los gráficos
+                        children=dcc.Loading(type='circle', children=[
+                            html.Div(id=f'{name}-wrapper', style={'display': 'none'}, children=dcc.Graph(id=f'{name}-graph'))
+                            for name in ADDITIONAL_GRAPHS
+                        ])
+                    )
+                ],
+                justify='center'
+            )
+
+        ]
+    )
+
+app.layout = serve_layout
 
 @app.callback(
-    [Output('results-container', 'children'),
-     Output('importance-heatmap-container', 'children'),
-     Output('prepared-patient-diabetes-store', 'data'),
-     Output('prepared-patient-hypertension-store', 'data')],
+    [Output('results-message', 'children'),
+     Output('patient-store', 'data'),
+     Output('importance-heatmap-wrapper', 'style'),
+     Output('explanation-diabetes', 'children'),
+     Output('explanation-hypertension', 'children')],
     [Input('submit-button', 'n_clicks')],
     [State('age-input', 'value'),
      State('bmi-input', 'value'),
      State('health-slider', 'value'),
      State('chest-pain-radio', 'value'),
-     State('pain-slider', 'value')]
+     State('pain-slider', 'value'),
+     State('consent-input', 'value'),
+     State('patient-store', 'data')]
 )
-def display_results(n_clicks, age, bmi, health, chest_pain, pain):
+@metrics.timed
+def display_results(n_clicks, age, bmi, health, chest_pain, pain, consent=None, previous=None):
     if n_clicks:
         try:
             if age is None or age <18 or bmi is None:
-                return "Por favor, complete todos los campos antes de continuar, e introduzca una edad mayor de 18.", [], None, None
+                return "Por favor, complete todos los campos antes de continuar, e introduzca una edad mayor de 18.", None, {'display': 'none'}, None, None
 
             # Preparar los datos del paciente
-            patient_diabetes = [bmi, categorizar_edad(age), health]
-            patient_hypertension = [chest_pain, 200 - age, pain]
-
-            diabetes_features_imp = ['BMI', 'Age', 'GenHlth']
-            prepared_patient_diabetes = prepare_patient_data_with_names(patient_diabetes, diabetes_features_imp)
-            hypertension_features_imp = ['cp', 'thalach', 'oldpeak']
-            prepared_patient_hypertension = prepare_patient_data_with_names(patient_hypertension, hypertension_features_imp)
+            patient = model_inputs(age, bmi, health, chest_pain, pain)
+            patient_diabetes = patient['diabetes'][0]
+            patient_hypertension = patient['hypertension'][0]
 
-            # Probabilidades
-            diabetes_prob = diabetes_model.predict_proba(prepared_patient_diabetes)[0][1]
-            hypertension_prob = hypertension_model.predict_proba(prepared_patient_hypertension)[0][1]
+            # Probabilidades (tabla precalculada o recorrido directo de los árboles, sin pandas)
+            models = get_models()
+            diabetes_prob = predict_risk(models['diabetes'], patient_diabetes)
+            hypertension_prob = predict_risk(models['hypertension'], patient_hypertension)
 
-            # Gráficos gauge
-            gauge_diabetes = create_gauge_chart(diabetes_prob, "Nivel de Riesgo Diabetes")
-            gauge_hypertension = create_gauge_chart(hypertension_prob, "Nivel de Riesgo Hipertensión")
-            
-
-            # Gráficos de importancia de variables y heatmaps
-            diabetes_importances_imp = [0.2117133332645621, 0.15305638261809465, 0.11646282783471759]
-            feature_importance_diabetes = plot_feature_importance(diabetes_features_imp, diabetes_importances_imp, title="Importancia de las Variables para Diabetes")
-            hypertension_importances_imp = [0.1491391772301424, 0.13647081077164086, 0.12473399197765939]
-            feature_importance_hypertension = plot_feature_importance(hypertension_features_imp, hypertension_importances_imp, title="Importancia de las Variables para Hipertensión")
-            feature_importance_diabetes.update_layout(height=400, width=600)
-            feature_importance_hypertension.update_layout(height=400, width=600)
-
-            df_diabetes, df_hypertension = load_data()
-            heatmap_diabetes = plot_heatmap(df_diabetes, diabetes_features_imp, "Heatmap de Variables para Diabetes")
-            heatmap_hypertension = plot_heatmap(df_hypertension, hypertension_features_imp, "Heatmap de Variables para Hipertensión")
-            heatmap_diabetes.update_layout(height=500, width=600)
-            heatmap_hypertension.update_layout(height=500, width=600)
-
-            # Gráficos alineados en filas y columnas
-            results_graphs = [
-                dbc.Row(
-                    [
-                        dbc.Col(dcc.Graph(figure=gauge_diabetes), width=9, style={'textAlign': 'center'}),
-                    ],
-                    justify='center'
-                ),
-                dbc.Row(
-                    [
-                        dbc.Col(dcc.Graph(figure=gauge_hypertension), width=9, style={'textAlign': 'center'}),
-                    ],
-                    justify='center'
-                )
-            ]
+            # Los gauges y los gráficos adicionales se alimentan de este registro
+            record = patient_record(age, bmi, health, chest_pain, pain, diabetes_prob, hypertension_prob)
+            # Con consentimiento se guarda una vez por envío distinto (no en cada click)
+            record['ingested'] = record_submission(record, previous, consent)
 
-            importance_heatmap_graphs = [
-                dbc.Row(
-                    [
-                        dbc.Col(dcc.Graph(figure=feature_importance_diabetes), width=6, style={'textAlign': 'center'}),
-                        dbc.Col(dcc.Graph(figure=feature_importance_hypertension), width=6, style={'textAlign': 'center'})
-                    ],
-                    justify='center'
-                ),
-                dbc.Row(
-                    [
-                        dbc.Col(dcc.Graph(figure=heatmap_diabetes), width=6, style={'textAlign': 'center'}),
-                        dbc.Col(dcc.Graph(figure=heatmap_hypertension), width=6, style={'textAlign': 'center'})
-                    ],
-                    justify='center'
-                )
+            # Cuánto mueve cada variable la probabilidad respecto a la media de la población
+            explanations = [
+                risk_explanation(models[disease], patient[disease][0])
+                for disease in ('diabetes', 'hypertension')
             ]
 
-            return results_graphs, importance_heatmap_graphs, prepared_patient_diabetes.to_dict(), prepared_patient_hypertension.to_dict()
+            return None, record, {'display': 'block'}, *explanations
 
         except Exception as e:
-            return f"Error al procesar los datos: {str(e)}", [], None, None
+            return f"Error al procesar los datos: {str(e)}", None, {'display': 'none'}, None, None
 
-    return "Introduzca los datos y haga click en Mostrar resultados.", [], None, None
+    return "Introduzca los datos y haga click en Mostrar resultados.", None, {'display': 'none'}, None, None
 
+# Explicación del riesgo de un paciente: riesgo medio de la población y la contribución
+# de cada variable (src.model.explain_risk), de mayor a menor, en puntos porcentuales
+def risk_explanation(model, features):
+    contributions = explain_risk(model, features)
+    items = [
+        html.Li(f"{FEATURE_LABELS[feature]}: {contribution * 100:+.1f} puntos",
+                style={'color': '#C62828' if contribution > 0 else '#2E7D32'})
+        for feature, contribution in sorted(zip(model['features'], contributions.tolist()), key=lambda item: -abs(item[1]))
+    ]
+    return [
+        html.P(f"Riesgo medio de la población: {float(model['explainer']['base']) * 100:.1f}%. Lo que más ha influido en su resultado:",
+               style={'marginBottom': '5px'}),
+        html.Ul(items)
+    ]
+
+
+
+# Actualizar los gauges en el navegador a partir de las probabilidades: mismo valor,
+# color y umbral que create_gauge_chart, sin que el servidor construya ni envíe la figura
+clientside_callback(
+    """
+    function(patient, gaugeDiabetes, gaugeHypertension) {
+        if (!patient) {
+            return [window.dash_clientside.no_update, window.dash_clientside.no_update, {'display': 'none'}];
+        }
+        function updateGauge(figure, probability) {
+            const updated = JSON.parse(JSON.stringify(figure));
+            const indicator = updated.data[0];
+            indicator.value = probability * 100;
+            indicator.gauge.bar.color = probability > 0.5 ? 'red' : 'green';
+            indicator.gauge.threshold.value = probability * 100;
+            return updated;
+        }
+        return [updateGauge(gaugeDiabetes, patient.diabetes_prob), updateGauge(gaugeHypertension, patient.hypertension_prob), {}];
+    }
+    """,
+    Output('gauge-diabetes', 'figure'),
+    Output('gauge-hypertension', 'figure'),
+    Output('gauges-wrapper', 'style'),
+    Input('patient-store', 'data'),
+    State('gauge-diabetes', 'figure'),
+    State('gauge-hypertension', 'figure')
+)
+
+# Versión de la que depende la base de población de cada gráfico adicional (incluye
+# los pacientes ingeridos, así que cambia cuando llega un segmento nuevo)
+def additional_graph_version(name, models):
+    if name == 'risk_diabetes':
+        return risk_population_version(models['diabetes'])
+    if name == 'risk_hypertension':
+        return risk_population_version(models['hypertension'])
+    if name == 'heart_rate_distribution':
+        return population_version('hypertension')
+    return population_version('diabetes')
 
+# Histograma de una columna a partir de los recuentos de valores de la población
+def population_histogram(name, col, title):
+    values, counts = sketch_values(population_sketch(name), col)
+    return plot_histogram_base(values, col, title, weights=counts)
 
-# Callback para los gráficos adicionales 
+# Petición a la caché de figuras de la base de población de cada gráfico adicional
+def additional_graph_base(name, models):
+    version = additional_graph_version(name, models)
+    if name == 'risk_diabetes':
+        return figure_request(name, None, version, None, lambda: plot_risk_distribution_base(
+            *risk_population('diabetes', models['diabetes']), "Comparación del riesgo de diabetes con la población"))
+    if name == 'risk_hypertension':
+        return figure_request(name, None, version, None, lambda: plot_risk_distribution_base(
+            *risk_population('hypertension', models['hypertension']), "Comparación del riesgo de hipertensión con la población"))
+    if name == 'bmi_distribution':
+        return figure_request(name, version, None, None, lambda: population_histogram(
+            'diabetes', 'BMI', "Comparación de BMI con la población"))
+    if name == 'age_distribution':
+        def build_age():
+            values, counts = sketch_values(population_sketch('diabetes'), 'Age')
+            return plot_age_distribution_base(values.astype(int), weights=counts)
+        return figure_request(name, version, None, None, build_age)
+    return figure_request(name, version, None, None, lambda: population_histogram(
+        'hypertension', 'thalach', "Comparación de su Frecuencia Cardíaca Máxima con la población"))
+
+# Línea del paciente de cada gráfico adicional, leída del registro del paciente
+# (las probabilidades ya se calcularon en display_results)
+def additional_graph_overlay(name, patient, models):
+    if name in ('risk_diabetes', 'risk_hypertension'):
+        disease = 'diabetes' if name == 'risk_diabetes' else 'hypertension'
+        probability = patient[f'{disease}_prob']
+        percentile = risk_percentile(disease, models[disease], probability)
+        return patient_overlay(probability, risk_patient_name(percentile))
+    if name == 'bmi_distribution':
+        return patient_overlay(patient['bmi'])
+    if name == 'age_distribution':
+        return patient_overlay(patient['age_group'])
+    return patient_overlay(patient['thalach'])
+
+# Callback para los gráficos adicionales: la base de población solo se envía cuando
+# el navegador no la tiene (o ha cambiado de versión); si ya la tiene, se envía un
+# Patch que únicamente mueve la línea del paciente
 @app.callback(
-    Output('additional-graphs-container', 'children'),
+    [Output(f'{name}-wrapper', 'style') for name in ADDITIONAL_GRAPHS] +
+    [Output(f'{name}-graph', 'figure') for name in ADDITIONAL_GRAPHS] +
+    [Output('additional-graphs-versions', 'data')],
     Input('show-graphs-button', 'n_clicks'),
     State('additional-graphs-checklist', 'value'),
-    State('prepared-patient-diabetes-store', 'data'),
-    State('prepared-patient-hypertension-store', 'data')
+    State('patient-store', 'data'),
+    State('additional-graphs-versions', 'data')
 )
-def display_additional_graphs(n_clicks, selected_graphs, prepared_patient_diabetes_data, prepared_patient_hypertension_data):
-    if n_clicks:
-        graphs = []
-
-        # Cargar los datos
-        df_diabetes, df_hypertension = load_data()
-        diabetes_features_imp = ['BMI', 'Age', 'GenHlth']
-        hypertension_features_imp = ['cp', 'thalach', 'oldpeak']
-
-        # Convertimos los datos almacenados de vuelta a DataFrames
-        prepared_patient_diabetes = pd.DataFrame.from_dict(prepared_patient_diabetes_data)
-        prepared_patient_hypertension = pd.DataFrame.from_dict(prepared_patient_hypertension_data)
-
-        # Generar las gráficas según las opciones seleccionadas
-        if 'risk_diabetes' in selected_graphs:
-            diabetes_population_probabilities = diabetes_model.predict_proba(df_diabetes[diabetes_features_imp])[:, 1] 
-            diabetes_prob = diabetes_model.predict_proba(prepared_patient_diabetes)[0][1]
-            graph = plot_risk_distribution(diabetes_population_probabilities, diabetes_prob, "Comparación del riesgo de diabetes con la población")
-            graphs.append(dcc.Graph(figure=graph))
-        
-        if 'risk_hypertension' in selected_graphs:
-            hypertension_population_probabilities = hypertension_model.predict_proba(df_hypertension[hypertension_features_imp])[:, 1]
-            hypertension_prob = hypertension_model.predict_proba(prepared_patient_hypertension)[0][1]
-            graph = plot_risk_distribution(hypertension_population_probabilities, hypertension_prob, "Comparación del riesgo de hipertensión con la población")
-            graphs.append(dcc.Graph(figure=graph))
-
-        if 'bmi_distribution' in selected_graphs:
-            graph = plot_histogram_with_patient(df_diabetes, prepared_patient_diabetes, 'BMI', "Comparación de BMI con la población")
-            graphs.append(dcc.Graph(figure=graph))
-
-        if 'age_distribution' in selected_graphs:
-            graph = plot_age_distribution(df_diabetes["Age"].to_numpy().astype(int), prepared_patient_diabetes['Age'].iloc[0].astype(int))
-            graphs.append(dcc.Graph(figure=graph))
-
-        if 'heart_rate_distribution' in selected_graphs:
-            graph = plot_histogram_with_patient(df_hypertension, prepared_patient_hypertension, 'thalach', "Comparación de su Frecuencia Cardíaca Máxima con la población")
-            graphs.append(dcc.Graph(figure=graph))
-
-        return graphs
-
-    return []
+@metrics.timed
+def display_additional_graphs(n_clicks, selected_graphs, patient, loaded_versions):
+    loaded_versions = dict(loaded_versions or {})
+    if not n_clicks:
+        return [{'display': 'none'}] * len(ADDITIONAL_GRAPHS) + [no_update] * len(ADDITIONAL_GRAPHS) + [loaded_versions]
+
+    # Bases que el navegador no tiene: se piden todas a la vez, así se construyen
+    # en paralelo y se comparten con las peticiones simultáneas que pidan las mismas.
+    # Toda la petición usa los mismos modelos aunque entre tanto se publique otra versión
+    models = get_models()
+    versions = {name: additional_graph_version(name, models) for name in selected_graphs}
+    bases = figure_cache.get_many({
+        name: additional_graph_base(name, models)
+        for name in selected_graphs if loaded_versions.get(name) != versions[name]
+    })
+
+    styles, figures = [], []
+    for name in ADDITIONAL_GRAPHS:
+        if name not in selected_graphs:
+            styles.append({'display': 'none'})
+            figures.append(no_update)
+            continue
+
+        styles.append({})
+        overlay = additional_graph_overlay(name, patient, models) if patient else {}
+        if name in bases:
+            figure = bases[name]
+            figure['data'][PATIENT_TRACE].update(overlay)
+            loaded_versions[name] = versions[name]
+        else:
+            figure = Patch()
+            for key, value in overlay.items():
+                figure['data'][PATIENT_TRACE][key] = value
+        figures.append(figure)
+
+    return styles + figures + [loaded_versions]
+
+# Endpoint de puntuación masiva: acepta un CSV (text/csv) o una lista JSON de
+# pacientes con age, bmi, health, chest_pain y pain, y devuelve los resultados por bloques
+# (con ?explain=1, también la contribución de cada variable). Los errores de formato se
+# comprueban antes de empezar a responder, para poder devolver un 400
+@server.route('/api/score', methods=['POST'])
+def score_patients():
+    explain = request.args.get('explain') == '1'
+    if request.mimetype == 'text/csv':
+        import pandas as pd
+        try:
+            chunks = iter_csv_chunks(request.stream)
+            # El primer bloque se lee ya para comprobar la cabecera
+            first = next(chunks, None)
+        except (pd.errors.EmptyDataError, pd.errors.ParserError) as e:
+            return {'error': f"CSV no válido: {e}"}, 400
+        if first is None:
+            return {'error': "El CSV está vacío"}, 400
+        missing = missing_columns(first.columns)
+        if missing:
+            return {'error': f"Faltan columnas: {', '.join(missing)}"}, 400
+        return Response(stream_with_context(stream_csv(get_models(), itertools.chain([first], chunks), explain)), mimetype='text/csv')
+
+    records = request.get_json(silent=True)
+    if isinstance(records, dict):
+        records = records.get('patients')
+    if not isinstance(records, list):
+        return {'error': "Envíe un CSV o una lista JSON de pacientes"}, 400
+    error = records_error(records)
+    if error:
+        return {'error': error}, 400
+    return Response(stream_with_context(stream_ndjson(get_models(), iter_record_chunks(records), explain)), mimetype='application/x-ndjson')
+
+# Cabecera Server-Timing con lo medido en cada petición (APPHEALTH_SERVER_TIMING=1),
+# visible en la pestaña de red del navegador. No incluye lo que se mide en el pool de
+# tareas ni en las respuestas por bloques (/api/score), que terminan después de enviar las cabeceras
+SERVER_TIMING = os.environ.get('APPHEALTH_SERVER_TIMING') == '1'
+
+@server.before_request
+def start_request_metrics():
+    if SERVER_TIMING:
+        metrics.start_request()
+
+@server.after_request
+def add_server_timing(response):
+    if SERVER_TIMING:
+        timing = metrics.server_timing(metrics.finish_request())
+        if timing:
+            response.headers['Server-Timing'] = timing
+    return response
+
+# Compresión de las respuestas de Dash (la página, el layout y los callbacks, todos
+# JSON o HTML): brotli si el navegador lo acepta y está instalado y si no gzip. No se
+# comprimen las respuestas por bloques (/api/score), las pequeñas ni los JS/CSS de Dash
+# (llevan caché de larga duración y el navegador solo los pide una vez)
+COMPRESS_MIMETYPES = {'application/json', 'text/html'}
+COMPRESS_MIN_BYTES = 500
+
+@server.after_request
+def compress_response(response):
+    if (response.mimetype not in COMPRESS_MIMETYPES or response.status_code != 200 or
+            response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if brotli is not None and request.accept_encodings.quality('br') > 0:
+        with metrics.span('response.brotli'):
+            response.set_data(brotli.compress(data, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif request.accept_encodings.quality('gzip') > 0:
+        with metrics.span('response.gzip'):
+            response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+# Histogramas de este worker en formato Prometheus
+@server.route('/metrics')
+def prometheus_metrics():
+    memory = memory_usage_mb()
+    text = metrics.render_prometheus({
+        'figure_cache_hits': ("Figuras servidas desde la caché", figure_cache.hits),
+        'figure_cache_misses': ("Figuras que hubo que construir", figure_cache.misses),
+        'figure_cache_entries': ("Figuras guardadas en la caché", len(figure_cache)),
+        'tasks_submitted': ("Tareas lanzadas en el pool", task_pool.submitted),
+        'tasks_coalesced': ("Peticiones agrupadas con una tarea ya en curso", task_pool.coalesced),
+        'memory_rss_mb': ("Memoria residente del worker (MB)", memory.get('rss')),
+        'memory_pss_mb': ("Memoria proporcional del worker (MB)", memory.get('pss'))
+    })
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+# Sonda de disponibilidad: 200 cuando los modelos y los datos ya están cargados,
+# con la versión de cada modelo que sirve este worker
+@server.route('/ready')
+def readiness():
+    if ready.is_set():
+        return {'ready': True, 'models': {disease: model['version'] for disease, model in get_models().items()}}
+    return {'ready': False}, 503
+
+# Población de referencia: filas, medianas y correlaciones del conjunto de datos más
+# los pacientes ingeridos, a partir de los resúmenes (sin recorrer los datos)
+@server.route('/api/population')
+def population():
+    return population_summary()
+
+# Memoria del worker que atiende la petición (para comprobar cuánto se comparte entre workers)
+@server.route('/api/memory')
+def worker_memory():
+    return {'pid': os.getpid(), 'memory_mb': memory_usage_mb()}
 
 if __name__ == '__main__':
+    warm_up()
+    watch_models()
+    start_ingest_thread()
     app.run_server(debug=True)
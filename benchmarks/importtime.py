@@ -0,0 +1,65 @@
+import argparse
+import subprocess
+import sys
+from benchmarks.run import ROOT
+
+# Informe de arranque a partir de python -X importtime:
+#   python -m benchmarks.importtime [--top 15]
+# Mide en procesos nuevos la importación de app.py y la carga posterior (warm_up),
+# y comprueba qué dependencias pesadas quedan importadas al servir.
+
+# Módulos que solo necesita el entrenamiento y no deberían importarse al servir
+TRAINING_ONLY = ['sklearn', 'sklearn.model_selection', 'sklearn.preprocessing', 'sklearn.metrics', 'joblib']
+HEAVY = ['pandas', 'plotly.express'] + TRAINING_ONLY
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+print("import_loaded " + ",".join(m for m in {heavy!r} if m in sys.modules))
+app.warm_up()
+ready = time.perf_counter()
+print(f"import_app {{imported - start:.3f}}")
+print(f"warm_up {{ready - imported:.3f}}")
+print("loaded " + ",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+# Tiempo propio de cada paquete (suma de sus submódulos) según -X importtime, en ms
+def parse_importtime(stderr):
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0.0) + int(own) / 1000
+    return packages
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Informe de arranque de AppHealth")
+    parser.add_argument('--top', type=int, default=15, help="Número de paquetes a mostrar")
+    args = parser.parse_args(argv)
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE.format(heavy=HEAVY)],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    timings = dict(line.split(' ', 1) for line in result.stdout.splitlines() if line)
+    packages = parse_importtime(result.stderr)
+
+    print(f"Importar app.py: {float(timings['import_app']) * 1000:8.0f} ms")
+    print(f"warm_up():       {float(timings['warm_up']) * 1000:8.0f} ms")
+    print("\nPaquetes importados por app.py y warm_up (tiempo propio):")
+    for name, ms in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {ms:8.1f} ms  {name}")
+
+    at_import = set(filter(None, timings['import_loaded'].split(',')))
+    loaded = set(filter(None, timings['loaded'].split(',')))
+    print("\nDependencias pesadas al importar app.py: " + (', '.join(sorted(at_import)) or 'ninguna'))
+    print("Dependencias pesadas tras warm_up():    " + (', '.join(sorted(loaded)) or 'ninguna'))
+    training = sorted(loaded & set(TRAINING_ONLY))
+    if training:
+        print("Atención: se han importado módulos de entrenamiento: " + ', '.join(training))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# Benchmarks de la app sobre datos sintéticos a varias escalas:
+#   python -m benchmarks.run [--scales 1 10 100] [--output resultados.json]
+#   python -m benchmarks.run --compare antes.json despues.json [--threshold 0.1]
+# Cada escala se mide en procesos nuevos, con sus propios datos, caché y artefactos,
+# así que no toca src/data, src/cache, src/artifacts ni src/segments.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_WORKDIR = os.path.join(ROOT, 'benchmarks', 'data')
+DEFAULT_RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+SHIPPED_DATA = {
+    'diabetes': os.path.join(ROOT, 'src', 'data', 'diabetes_data.csv'),
+    'hypertension': os.path.join(ROOT, 'src', 'data', 'hypertension_data.csv')
+}
+
+# Pacientes fijos con los que se llaman los callbacks: (edad, BMI, salud, dolor de pecho, dolor)
+PATIENTS = [
+    (18, 19.5, 1, 0, 6.0), (23, 22.0, 2, 0, 5.5), (29, 24.3, 2, 1, 4.0), (34, 27.5, 3, 0, 3.0),
+    (38, 31.2, 4, 2, 1.5), (42, 26.0, 3, 3, 2.3), (47, 35.8, 5, 2, 0.5), (51, 29.9, 3, 1, 3.6),
+    (55, 23.4, 2, 0, 4.4), (58, 41.0, 5, 2, 0.0), (61, 28.1, 3, 3, 2.0), (64, 33.3, 4, 1, 1.1),
+    (67, 25.6, 3, 0, 3.2), (70, 30.4, 4, 2, 1.8), (73, 21.7, 2, 3, 4.9), (76, 27.0, 3, 1, 2.6),
+    (79, 36.5, 5, 2, 0.3), (82, 24.9, 4, 0, 3.9), (88, 26.2, 4, 1, 2.9), (95, 22.8, 5, 3, 1.0)
+]
+
+# Número de peticiones y clientes simultáneos de la prueba de carga
+LOAD_REQUESTS = 200
+LOAD_CLIENTS = [1, 4, 8]
+
+# Datos sintéticos: filas de los CSV incluidos tomadas al azar con reemplazo (misma
+# distribución), 'scale' veces su tamaño. Se generan una vez y se reutilizan.
+def generate_data(workdir, scale, seed=0):
+    import numpy as np
+    import pandas as pd
+
+    paths = {}
+    for name, source in SHIPPED_DATA.items():
+        path = os.path.join(workdir, f'{scale}x', f'{name}_data.csv')
+        paths[name] = path
+        if os.path.isfile(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shipped = pd.read_csv(source)
+        rng = np.random.default_rng(seed)
+        tmp_path = path + f'.tmp-{os.getpid()}'
+        for i in range(scale):
+            sample = shipped.iloc[rng.integers(0, len(shipped), len(shipped))]
+            sample.to_csv(tmp_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+        os.replace(tmp_path, path)
+    return paths
+
+# Apuntar la app a los datos, la caché y los artefactos de una escala (antes de importar app)
+def bootstrap(workdir, scale):
+    import src.etl
+    import src.ingest
+    import src.model
+    scale_dir = os.path.join(workdir, f'{scale}x')
+    src.etl.DATA_PATHS = {name: os.path.join(scale_dir, f'{name}_data.csv') for name in SHIPPED_DATA}
+    src.etl.CACHE_DIR = os.path.join(scale_dir, 'cache')
+    src.model.ARTIFACTS_DIR = os.path.join(scale_dir, 'artifacts')
+    src.ingest.SEGMENTS_DIR = os.path.join(scale_dir, 'segments')
+
+# Estadísticas de una lista de tiempos en segundos, en milisegundos
+def summarize(seconds):
+    ms = sorted(s * 1000 for s in seconds)
+    return {
+        'n': len(ms),
+        'min_ms': ms[0],
+        'median_ms': statistics.median(ms),
+        'p95_ms': ms[min(len(ms) - 1, int(round(0.95 * (len(ms) - 1))))],
+        'mean_ms': statistics.fmean(ms)
+    }
+
+def measure(fn, repeat=1):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return summarize(seconds)
+
+# Arranque en un proceso nuevo (importar app.py y warm_up()): en frío (sin caché ni
+# artefactos, así que entrena los modelos) y en caliente (carga los artefactos)
+def bench_import(workdir, scale):
+    import shutil
+    scale_dir = os.path.join(workdir, f'{scale}x')
+    for name in ('cache', 'artifacts', 'segments'):
+        shutil.rmtree(os.path.join(scale_dir, name), ignore_errors=True)
+
+    code = f"from benchmarks.run import bootstrap; bootstrap({workdir!r}, {scale}); import app; app.warm_up()"
+    results = {}
+    for case in ('cold_import', 'warm_import'):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        results[case] = summarize([time.perf_counter() - start])
+    return results
+
+# Cuerpo de una petición a /_dash-update-component para el callback que tiene 'output_id'
+def dash_request(dependencies, output_id, inputs, state):
+    dependency = next(d for d in dependencies if output_id in d['output'])
+    outputs = [
+        {'id': output.rsplit('.', 1)[0], 'property': output.rsplit('.', 1)[1]}
+        for output in dependency['output'].strip('.').split('...')
+    ]
+    return {
+        'output': dependency['output'],
+        'outputs': outputs,
+        'inputs': [dict(id=d['id'], property=d['property'], value=v) for d, v in zip(dependency['inputs'], inputs)],
+        'state': [dict(id=d['id'], property=d['property'], value=v) for d, v in zip(dependency['state'], state)],
+        'changedPropIds': [f"{dependency['inputs'][0]['id']}.{dependency['inputs'][0]['property']}"]
+    }
+
+# Prueba de carga contra el servidor Flask con el cliente de pruebas: varios clientes
+# en paralelo envían el formulario, piden los gráficos adicionales y puntúan un CSV
+def bench_load(app):
+    client = app.server.test_client()
+    client.get('/')
+    dependencies = client.get('/_dash-dependencies').get_json()
+    records = [app.patient_record(*patient, 0.5, 0.5) for patient in PATIENTS]
+    bodies = []
+    for patient, record in zip(PATIENTS, records):
+        bodies.append(('/_dash-update-component', dash_request(dependencies, 'results-message', [1], list(patient) + [[], None])))
+        bodies.append(('/_dash-update-component', dash_request(
+            dependencies, 'additional-graphs-versions', [1], [app.ADDITIONAL_GRAPHS, record, None])))
+    score_csv = 'age,bmi,health,chest_pain,pain\n' + ''.join(f'{a},{b},{h},{c},{p}\n' for a, b, h, c, p in PATIENTS * 5)
+
+    # Una de cada cinco peticiones es de puntuación masiva
+    def send(i):
+        start = time.perf_counter()
+        if i % 5 == 4:
+            path = '/api/score'
+            response = app.server.test_client().post(path, data=score_csv, content_type='text/csv')
+        else:
+            path, body = bodies[i % len(bodies)]
+            response = app.server.test_client().post(path, json=body)
+        response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} devolvió {response.status_code}")
+        return time.perf_counter() - start
+
+    results = {}
+    for clients in LOAD_CLIENTS:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            latencies = list(pool.map(send, range(LOAD_REQUESTS)))
+        elapsed = time.perf_counter() - start
+        results[f'load_{clients}_clients'] = dict(summarize(latencies), requests_per_s=LOAD_REQUESTS / elapsed)
+    return results
+
+# Tipo de gráfico (src.serialize.FIGURE_PRECISION) de cada figura que se serializa
+SERIALIZED_PLOTS = {
+    'create_gauge_chart': 'gauge',
+    'plot_feature_importance': 'feature_importance',
+    'plot_correlation_heatmap': 'heatmap',
+    'plot_histogram_base': 'bmi_distribution',
+    'plot_risk_distribution_base': 'risk_diabetes',
+    'plot_age_distribution_base': 'age_distribution'
+}
+
+# Serialización de cada figura con el codificador de plotly (fig.to_json, el de antes)
+# y con el compacto de src.serialize: tiempo, bytes y bytes con gzip. Y bytes de las
+# respuestas de Dash sin comprimir y comprimidas, tal como salen por la red
+def bench_serialization(app, plots):
+    import gzip
+    from src.serialize import figure_json
+
+    results = {}
+    for name, chart in SERIALIZED_PLOTS.items():
+        fig = plots[name]()
+        for case, encode in (('plotly', fig.to_json), ('compact', lambda: figure_json(fig, chart))):
+            encoded = encode().encode()
+            results[f'encode_{case}.{name}'] = dict(measure(encode, repeat=20), bytes=len(encoded), gzip_bytes=len(gzip.compress(encoded)))
+
+    client = app.server.test_client()
+    dependencies = client.get('/_dash-dependencies').get_json()
+    record = app.patient_record(*PATIENTS[0], 0.5, 0.5)
+    body = dash_request(dependencies, 'additional-graphs-versions', [1], [app.ADDITIONAL_GRAPHS, record, None])
+    responses = {
+        'layout': lambda headers: client.get('/_dash-layout', headers=headers),
+        'additional_graphs': lambda headers: client.post('/_dash-update-component', json=body, headers=headers)
+    }
+    for name, send in responses.items():
+        for encoding in ('identity', 'gzip', 'br'):
+            response = send({'Accept-Encoding': encoding})
+            sent = response.headers.get('Content-Encoding', 'identity')
+            results[f'wire.{name}.{encoding}'] = dict(measure(lambda: send({'Accept-Encoding': encoding}).get_data(), repeat=10),
+                                                     bytes=len(response.get_data()), encoding=sent)
+    return results
+
+# Ingesta de pacientes (src.ingest): escribir un segmento de INGEST_FLUSH_ROWS pacientes,
+# sumarlo al estado, puntuarlo y rehacer el resumen de la población, frente a recalcular
+# la correlación recorriendo todo el conjunto de datos. Empieza y acaba sin segmentos
+def bench_ingest(models):
+    import shutil
+    from src import etl, ingest
+    from src.features import FEATURES
+    records = [dict(zip(ingest.RECORD_COLUMNS, patient)) for patient in PATIENTS]
+    records = (records * (ingest.INGEST_FLUSH_ROWS // len(records) + 1))[:ingest.INGEST_FLUSH_ROWS]
+    shutil.rmtree(ingest.SEGMENTS_DIR, ignore_errors=True)
+
+    results = {}
+    results['ingest.append_segment'] = measure(lambda: ingest.append_records(records), repeat=10)
+    results['ingest.refresh_state'] = measure(ingest.refresh_state)
+    results['ingest.risk_counts'] = measure(lambda: ingest.ingested_risk_counts('diabetes', models['diabetes']))
+    ingest.append_records(records)
+    results['ingest.refresh_one_segment'] = measure(ingest.refresh_state)
+    results['ingest.population_summary'] = measure(ingest.population_summary, repeat=5)
+    diabetes = etl.get_dataset('diabetes')
+    results['ingest.full_correlation'] = measure(lambda: diabetes[FEATURES['diabetes']].corr(), repeat=5)
+    shutil.rmtree(ingest.SEGMENTS_DIR, ignore_errors=True)
+    ingest.refresh_state()
+    return results
+
+# Casos que se miden dentro del proceso, con la app ya importada
+def bench_in_process(workdir, scale):
+    bootstrap(workdir, scale)
+    import numpy as np
+    import app
+    from src import etl, graphics
+    from src.model import get_models
+    from src.figure_cache import figure_cache
+    app.warm_up()
+
+    results = {'load_data': measure(etl.load_data, repeat=3)}
+
+    seconds = []
+    for patient in PATIENTS:
+        start = time.perf_counter()
+        app.display_results(1, *patient)
+        seconds.append(time.perf_counter() - start)
+    results['display_results'] = summarize(seconds)
+
+    # Explicación de los dos riesgos de cada paciente: con la tabla por intervalos (la que
+    # se usa al servir) y recorriendo las cajas de las hojas (la referencia)
+    from src.model import explain_flat, explain_risk
+    models = get_models()
+    explainers = {
+        'explain_risk': lambda model, X: explain_risk(model, X),
+        'explain_flat': lambda model, X: explain_flat(model['explainer'], X)
+    }
+    for name, explain in explainers.items():
+        seconds = []
+        for patient in PATIENTS:
+            X = app.model_inputs(*patient)
+            start = time.perf_counter()
+            for disease, model in models.items():
+                explain(model, X[disease][0])
+            seconds.append(time.perf_counter() - start)
+        results[name] = summarize(seconds)
+    batch = app.model_inputs(*(np.resize(np.array(column, dtype=float), 4096) for column in zip(*PATIENTS)))
+    results['explain_risk_batch_4096'] = measure(lambda: [explain_risk(model, batch[disease]) for disease, model in models.items()], repeat=5)
+    # Lote fuera de la rejilla: edad con decimales e IMC con dos decimales
+    columns = [np.resize(np.array(column, dtype=float), 4096) for column in zip(*PATIENTS)]
+    columns[0] = columns[0] + np.linspace(0, 0.9, 4096)
+    columns[1] = np.linspace(16.01, 44.99, 4096).round(2)
+    offgrid = app.model_inputs(*columns)
+    results['explain_risk_offgrid_batch_4096'] = measure(lambda: [explain_risk(model, offgrid[disease]) for disease, model in models.items()], repeat=5)
+
+    records = [app.patient_record(*patient, 0.5, 0.5) for patient in PATIENTS]
+    graphs = app.ADDITIONAL_GRAPHS
+    def additional_graphs(loaded_versions, clear):
+        seconds = []
+        for record in records:
+            if clear:
+                figure_cache.clear()
+            start = time.perf_counter()
+            app.display_additional_graphs(1, graphs, record, loaded_versions)
+            seconds.append(time.perf_counter() - start)
+        return summarize(seconds)
+    versions = {name: app.additional_graph_version(name, get_models()) for name in graphs}
+    results['display_additional_graphs_cold'] = additional_graphs({}, clear=True)
+    results['display_additional_graphs_full'] = additional_graphs({}, clear=False)
+    results['display_additional_graphs_patch'] = additional_graphs(versions, clear=False)
+
+    # Cada función de src/graphics.py con los datos y modelos de la escala
+    diabetes, hypertension = etl.get_datasets()
+    population = get_models()['diabetes']['population']
+    report = get_models()['diabetes']['report']
+    features = report['features']
+    ages = diabetes['Age'].to_numpy().astype(int)
+    plots = {
+        'create_gauge_chart': lambda: graphics.create_gauge_chart(0.42),
+        'plot_feature_importance': lambda: graphics.plot_feature_importance(features, report['feature_importances']),
+        'plot_heatmap': lambda: graphics.plot_heatmap(diabetes, features),
+        'plot_correlation_heatmap': lambda: graphics.plot_correlation_heatmap(report['correlation'], features),
+        'plot_histogram_base': lambda: graphics.plot_histogram_base(diabetes['BMI'], 'BMI', "BMI"),
+        'plot_histogram_with_patient': lambda: graphics.plot_histogram_with_patient(hypertension, hypertension.iloc[:1], 'thalach', "thalach"),
+        'plot_risk_distribution_base': lambda: graphics.plot_risk_distribution_base(population['counts'], population['bins']),
+        'plot_risk_distribution': lambda: graphics.plot_risk_distribution(population['counts'], population['bins'], 0.42),
+        'plot_age_distribution_base': lambda: graphics.plot_age_distribution_base(ages),
+        'plot_age_distribution': lambda: graphics.plot_age_distribution(ages, 6)
+    }
+    for name, plot in plots.items():
+        results[f'graphics.{name}'] = measure(plot, repeat=5)
+    results.update(bench_serialization(app, plots))
+    results.update(bench_ingest(get_models()))
+
+    results.update(bench_load(app))
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(scales, workdir, output):
+    results = {}
+    for scale in scales:
+        print(f"Escala {scale}x: generando datos...", file=sys.stderr)
+        generate_data(workdir, scale)
+        print(f"Escala {scale}x: importación en frío y en caliente...", file=sys.stderr)
+        scale_results = bench_import(workdir, scale)
+        print(f"Escala {scale}x: callbacks, gráficos y carga...", file=sys.stderr)
+        worker = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.run', '--in-process', str(scale), '--workdir', workdir],
+            cwd=ROOT, check=True, capture_output=True, text=True)
+        scale_results.update(json.loads(worker.stdout))
+        results[f'{scale}x'] = scale_results
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'results': results
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Resultados guardados en {output}", file=sys.stderr)
+    return report
+
+# Comparar dos ficheros de resultados: mediana de latencia (más es peor) o peticiones
+# por segundo (menos es peor). Devuelve las regresiones que superan el umbral.
+def compare(old_path, new_path, threshold):
+    with open(old_path) as f:
+        old = json.load(f)['results']
+    with open(new_path) as f:
+        new = json.load(f)['results']
+
+    regressions = []
+    for scale in sorted(set(old) & set(new)):
+        for case in sorted(set(old[scale]) & set(new[scale])):
+            before, after = old[scale][case], new[scale][case]
+            if 'requests_per_s' in before:
+                metric, ratio = 'requests_per_s', before['requests_per_s'] / after['requests_per_s']
+            else:
+                metric, ratio = 'median_ms', after['median_ms'] / before['median_ms']
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = '  REGRESIÓN'
+                regressions.append((scale, case, ratio))
+            print(f"{scale:>5} {case:<40} {metric:<15} {before[metric]:12.2f} -> {after[metric]:12.2f}  x{ratio:.2f}{flag}")
+            # Bytes de las figuras y respuestas: se muestran, pero no cuentan como regresión
+            if 'bytes' in before and 'bytes' in after:
+                print(f"{scale:>5} {case:<40} {'bytes':<15} {before['bytes']:12d} -> {after['bytes']:12d}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de AppHealth")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help="Tamaño de los datos respecto a los CSV incluidos")
+    parser.add_argument('--workdir', default=DEFAULT_WORKDIR, help="Directorio de los datos sintéticos, la caché y los artefactos")
+    parser.add_argument('--output', help="Fichero JSON de resultados (por defecto benchmarks/results/<commit>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('ANTES', 'DESPUES'), help="Comparar dos ficheros de resultados")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Empeoramiento relativo a partir del cual se marca una regresión")
+    parser.add_argument('--in-process', type=int, metavar='ESCALA', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        regressions = compare(*args.compare, args.threshold)
+        sys.exit(1 if regressions else 0)
+    if args.in_process:
+        # La salida estándar se reserva para el JSON de resultados
+        with contextlib.redirect_stdout(sys.stderr):
+            results = bench_in_process(args.workdir, args.in_process)
+        json.dump(results, sys.stdout)
+        return
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"{git_commit() or 'resultados'}.json")
+    run(args.scales, args.workdir, output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import gc
+import os
+
+# Configuración de gunicorn (Procfile y render.yaml): gunicorn --config gunicorn.conf.py app:server
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+# Varios hilos por worker: mientras uno espera a que se construya un gráfico, el resto
+# sigue atendiendo, y las peticiones del mismo gráfico esperan a una sola construcción
+# (src.tasks.task_pool)
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+
+# El proceso maestro importa la app una sola vez (modelos, arrays del bosque, tablas
+# de consulta y datasets mapeados desde disco) y los workers se crean con fork, así
+# que comparten esas páginas en lugar de tener cada uno su copia.
+# APPHEALTH_PRELOAD=0 vuelve a cargar la app en cada worker.
+preload_app = os.environ.get('APPHEALTH_PRELOAD', '1') != '0'
+
+# Los modelos y los datos se cargan en warm_up() (app.py): en el maestro si hay
+# preload_app, para que los workers los hereden, y si no en cada worker antes de
+# atender peticiones
+def when_ready(server):
+    if preload_app:
+        import app
+        app.warm_up()
+        # Sacar del recolector de basura los objetos ya creados: si no, al recorrerlos
+        # escribe en sus cabeceras y cada worker acaba copiando esas páginas
+        gc.freeze()
+
+# Cada worker consulta el registro de modelos (src/artifacts/<enfermedad>/CURRENT) cada
+# APPHEALTH_MODEL_POLL segundos y cambia en caliente a la versión publicada, y cada
+# APPHEALTH_INGEST_SECONDS escribe los pacientes que ha recibido y suma los segmentos nuevos (src.ingest)
+def post_worker_init(worker):
+    import app
+    if not preload_app:
+        app.warm_up()
+    app.watch_models(worker.log.info)
+    from src.ingest import start_ingest_thread
+    start_ingest_thread(worker.log.info)
+    from src.model import memory_usage_mb
+    memory = memory_usage_mb()
+    worker.log.info("Worker %s: %s", worker.pid,
+                    ', '.join(f"{key} {value:.0f} MB" for key, value in memory.items() if value is not None))
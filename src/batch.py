@@ -0,0 +1,130 @@
+import argparse
+import sys
+import numpy as np
+from src.features import FEATURES, model_inputs
+from src.model import explain_risk, load_models, predict_risk
+from src.serialize import dumps
+
+# Columnas de entrada (las mismas del formulario) y valores por defecto del formulario
+INPUT_COLUMNS = ['age', 'bmi', 'health', 'chest_pain', 'pain']
+INPUT_DEFAULTS = {'health': 3, 'chest_pain': 0, 'pain': 3}
+# Columnas sin valor por defecto
+REQUIRED_COLUMNS = ['age', 'bmi']
+OUTPUT_COLUMNS = INPUT_COLUMNS + ['diabetes_prob', 'hypertension_prob']
+# Con explain: contribución de cada variable de cada modelo (src.model.explain_risk)
+EXPLAIN_COLUMNS = [f'{disease}_{feature}' for disease, features in FEATURES.items() for feature in features]
+
+# Número de pacientes que se puntúan de una vez
+CHUNK_SIZE = 4096
+
+def missing_columns(columns):
+    return [col for col in REQUIRED_COLUMNS if col not in columns]
+
+# Error de una lista JSON de pacientes (None si se puede puntuar). Se comprueba antes de
+# empezar a responder: una vez enviadas las cabeceras ya no se puede devolver un 400.
+# Una lista vacía es válida (respuesta vacía)
+def records_error(records):
+    if not records:
+        return None
+    if not all(isinstance(record, dict) for record in records):
+        return "Cada paciente debe ser un objeto JSON"
+    missing = missing_columns({key for record in records for key in record})
+    if missing:
+        return f"Faltan columnas: {', '.join(missing)}"
+    return None
+
+# Columnas de entrada numéricas, con los valores por defecto del formulario
+# (la misma normalización para la puntuación masiva y para src.ingest)
+def normalize_inputs(chunk):
+    import pandas as pd
+    chunk = pd.DataFrame(chunk)
+    for col, default in INPUT_DEFAULTS.items():
+        chunk[col] = chunk[col].fillna(default) if col in chunk else default
+    missing = missing_columns(chunk.columns)
+    if missing:
+        raise ValueError(f"Faltan columnas: {', '.join(missing)}")
+    return chunk[INPUT_COLUMNS].apply(pd.to_numeric, errors='coerce')
+
+# Puntuar un bloque de pacientes con los dos modelos, con la misma
+# transformación que display_results (categoría de edad y thalach = 200 - edad)
+def score_chunk(models, chunk, explain=False):
+    inputs = normalize_inputs(chunk)
+    age = inputs['age'].to_numpy(dtype=float)
+    X = model_inputs(age, inputs['bmi'], inputs['health'], inputs['chest_pain'], inputs['pain'])
+    diabetes_features, hypertension_features = X['diabetes'], X['hypertension']
+
+    # Igual que en el formulario: edad mayor de 18 y todos los campos completos
+    valid = (age >= 18) & ~np.isnan(diabetes_features).any(axis=1) & ~np.isnan(hypertension_features).any(axis=1)
+
+    result = inputs.copy()
+    result['diabetes_prob'] = np.nan
+    result['hypertension_prob'] = np.nan
+    if valid.any():
+        result.loc[valid, 'diabetes_prob'] = predict_risk(models['diabetes'], diabetes_features[valid])
+        result.loc[valid, 'hypertension_prob'] = predict_risk(models['hypertension'], hypertension_features[valid])
+    if not explain:
+        return result[OUTPUT_COLUMNS]
+
+    for disease in FEATURES:
+        contributions = np.full((len(result), len(FEATURES[disease])), np.nan)
+        if valid.any():
+            contributions[valid] = explain_risk(models[disease], X[disease][valid])
+        for i, feature in enumerate(FEATURES[disease]):
+            result[f'{disease}_{feature}'] = contributions[:, i]
+    return result[OUTPUT_COLUMNS + EXPLAIN_COLUMNS]
+
+# Dividir una lista de registros (diccionarios) en bloques. Todos los bloques tienen las
+# columnas de entrada (vacías si ningún paciente del bloque las trae)
+def iter_record_chunks(records, chunk_size=CHUNK_SIZE):
+    import pandas as pd
+    for start in range(0, len(records), chunk_size):
+        yield pd.DataFrame.from_records(records[start:start + chunk_size], columns=INPUT_COLUMNS)
+
+# Leer un CSV (fichero o flujo) por bloques
+def iter_csv_chunks(source, chunk_size=CHUNK_SIZE):
+    import pandas as pd
+    return pd.read_csv(source, chunksize=chunk_size)
+
+# Generadores de salida: se va devolviendo cada bloque en cuanto está puntuado
+def stream_csv(models, chunks, explain=False):
+    header = True
+    for chunk in chunks:
+        yield score_chunk(models, chunk, explain).to_csv(index=False, header=header)
+        header = False
+
+# Una línea JSON por paciente con la misma precisión que el CSV (to_json recorta a 10
+# decimales); los valores vacíos salen como null
+def ndjson_lines(result):
+    records = result.astype(object).where(result.notna(), None).to_dict('records')
+    return ''.join(dumps(record) + '\n' for record in records)
+
+def stream_ndjson(models, chunks, explain=False):
+    for chunk in chunks:
+        yield ndjson_lines(score_chunk(models, chunk, explain))
+
+# Herramienta de línea de comandos:
+#   python -m src.batch pacientes.csv -o resultados.csv [--explain]
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Puntuación masiva de pacientes con los modelos de AppHealth")
+    parser.add_argument('input', help="CSV con columnas age, bmi, health, chest_pain, pain ('-' para stdin)")
+    parser.add_argument('-o', '--output', default='-', help="Fichero de salida ('-' para stdout)")
+    parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--explain', action='store_true', help="Añadir la contribución de cada variable a cada probabilidad")
+    args = parser.parse_args(argv)
+
+    models = load_models()
+    source = sys.stdin if args.input == '-' else args.input
+    chunks = iter_csv_chunks(source, args.chunk_size)
+    stream = stream_csv if args.format == 'csv' else stream_ndjson
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    try:
+        for text in stream(models, chunks, args.explain):
+            output.write(text)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,65 +1,347 @@
-import pandas as pd
+import hashlib
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+import numpy as np
+from src.features import FEATURES, age_groups
+from src.metrics import timed
+
+try:
+    import fcntl
+except ImportError:  # sin fcntl (Windows) no hay bloqueo entre procesos; la instalación tolera la carrera
+    fcntl = None
+
+# pandas se importa al cargar los datos y no al importar el módulo (arranque más rápido)
+
+# Rutas de los ficheros de datos de cada enfermedad
+DATA_PATHS = {
+    'diabetes': 'src/data/diabetes_data.csv',
+    'hypertension': 'src/data/hypertension_data.csv'
+}
+
+# Función para cargar un único conjunto de datos, ya limpio (valores faltantes
+# rellenados con la mediana). Sale de la caché columnar, que se construye leyendo
+# el CSV por bloques, así que el fichero nunca tiene que caber entero en memoria
+@timed
+def load_dataset(name):
+    return get_dataset(name)
 
 # Función para cargar los datos
+@timed
 def load_data():
-    df_diabetes = pd.read_csv('src/data/diabetes_data.csv')
-    df_hypertension = pd.read_csv('src/data/hypertension_data.csv')
-
-    # Llenar valores faltantes
-    df_diabetes = df_diabetes.fillna(df_diabetes.median())
-    df_hypertension = df_hypertension.fillna(df_hypertension.median())
+    df_diabetes = load_dataset('diabetes')
+    df_hypertension = load_dataset('hypertension')
 
     return df_diabetes, df_hypertension
 
+# Hash SHA-256 del fichero de datos, para saber si hay que reentrenar
+def data_hash(name):
+    sha = hashlib.sha256()
+    with open(DATA_PATHS[name], 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+# Directorio de la caché columnar (un .npy por columna, ya limpio y con tipos compactos)
+CACHE_DIR = 'src/cache'
+
+# Caché del proceso: nombre -> (mtime del CSV, versión, DataFrame de solo lectura, resumen)
+_DATASETS = {}
+_DATASETS_LOCK = threading.Lock()
+
+# Bloqueo entre procesos (los workers de gunicorn, src.batch...) mientras uno reconstruye
+# algo en disco: los demás esperan y después usan lo que ha dejado
+@contextmanager
+def file_lock(path):
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# Esquema de cada conjunto de datos: solo las columnas que usan los modelos
+# (src.features.FEATURES y TARGETS) o los gráficos, con su tipo compacto y su rango
+# válido (mínimo, máximo). El resto de columnas del CSV no se leen.
+SCHEMAS = {
+    'diabetes': {
+        'Age': ('int8', 1, 13),          # categoría de edad (src.features.AGE_GROUP_STARTS)
+        'BMI': ('float32', 10, 100),
+        'GenHlth': ('int8', 1, 5),
+        'Diabetes': ('int8', 0, 1)
+    },
+    'hypertension': {
+        'cp': ('int8', 0, 3),
+        'thalach': ('int16', 40, 250),
+        'oldpeak': ('float32', 0, 10),
+        'target': ('int8', 0, 1)
+    }
+}
+
+# Filas por bloque al leer el CSV
+CHUNK_ROWS = 100_000
+# Resolución de las medianas aproximadas de las columnas continuas
+MEDIAN_RESOLUTION = 0.01
+
+def column_dtype(name, col):
+    return np.dtype(SCHEMAS[name][col][0])
+
+# Resolución con la que se cuentan los valores de una columna: exacta en las enteras
+def column_resolution(name, col):
+    return None if column_dtype(name, col).kind == 'i' else MEDIAN_RESOLUTION
+
+# Leer por bloques las columnas del esquema; se parsean como float32 (admite NaN y "57.0")
+def iter_csv_blocks(name, chunk_rows=CHUNK_ROWS):
+    import pandas as pd
+    return pd.read_csv(DATA_PATHS[name], usecols=list(SCHEMAS[name]), chunksize=chunk_rows, dtype=np.float32)
+
+# Sumar a 'counts' (valor -> número de filas) los valores no vacíos de un bloque,
+# redondeados a 'resolution' si se indica: la memoria depende del número de valores
+# distintos, no del número de filas, y los recuentos de varios bloques se suman
+def update_value_counts(counts, values, resolution=None):
+    values = values[~np.isnan(values)]
+    if resolution is not None:
+        # El segundo redondeo quita los restos de coma flotante (27.000000000000004)
+        values = np.round(np.round(values / resolution) * resolution, 9)
+    keys, n = np.unique(values, return_counts=True)
+    for key, count in zip(keys.tolist(), n.tolist()):
+        counts[key] = counts.get(key, 0) + count
+
+# Mediana a partir de los recuentos (con un número par de valores, la media de los dos centrales, como pandas)
+def median_from_counts(counts):
+    if not counts:
+        return np.nan
+    keys = sorted(counts)
+    cumulative = np.cumsum([counts[key] for key in keys])
+    total = cumulative[-1]
+    lower = keys[np.searchsorted(cumulative, (total - 1) // 2, side='right')]
+    upper = keys[np.searchsorted(cumulative, total // 2, side='right')]
+    return (lower + upper) / 2
+
+# Resumen combinable de un conjunto de datos ('sketch'): número de filas, recuentos de
+# valores de cada columna (dan medianas e histogramas) y momentos de las variables del
+# modelo (dan la matriz de correlación). Todo son sumas, así que el resumen de varios
+# bloques o segmentos es la suma de sus resúmenes (merge_sketches) y añadir datos
+# nuevos no obliga a volver a leer los anteriores (src.ingest)
+def empty_sketch():
+    return {'rows': 0, 'counts': {}, 'moments': {}}
+
+def update_moments(moments, X):
+    X = np.asarray(X, dtype=np.float64)
+    moments['n'] = moments.get('n', 0) + len(X)
+    moments['sum'] = moments.get('sum', 0.0) + X.sum(axis=0)
+    moments['products'] = moments.get('products', 0.0) + X.T @ X
+
+def update_moments_from(moments, other):
+    moments['n'] = moments.get('n', 0) + other['n']
+    moments['sum'] = moments.get('sum', 0.0) + np.asarray(other['sum'])
+    moments['products'] = moments.get('products', 0.0) + np.asarray(other['products'])
+
+# Añadir al resumen un bloque de columnas ya limpias {columna: valores}
+def update_sketch(sketch, name, columns):
+    sketch['rows'] += len(next(iter(columns.values())))
+    for col, values in columns.items():
+        update_value_counts(sketch['counts'].setdefault(col, {}), np.asarray(values, dtype=np.float64), column_resolution(name, col))
+    if all(col in columns for col in FEATURES[name]):
+        update_moments(sketch['moments'], np.column_stack([columns[col] for col in FEATURES[name]]))
+
+def merge_sketches(a, b):
+    merged = {'rows': a['rows'] + b['rows'], 'counts': {}, 'moments': {}}
+    for col in set(a['counts']) | set(b['counts']):
+        counts = dict(a['counts'].get(col, {}))
+        for value, count in b['counts'].get(col, {}).items():
+            counts[value] = counts.get(value, 0) + count
+        merged['counts'][col] = counts
+    for moments in (a['moments'], b['moments']):
+        if moments:
+            update_moments_from(merged['moments'], moments)
+    return merged
+
+# Matriz de correlación (Pearson, como DataFrame.corr) a partir de los momentos
+def correlation_from_moments(moments):
+    n = moments['n']
+    mean = np.asarray(moments['sum']) / n
+    covariance = np.asarray(moments['products']) / n - np.outer(mean, mean)
+    std = np.sqrt(np.diag(covariance))
+    return covariance / np.outer(std, std)
+
+# Valores y recuentos ordenados de una columna del resumen (para histogramas con pesos)
+def sketch_values(sketch, col):
+    counts = sketch['counts'].get(col, {})
+    values = np.array(sorted(counts), dtype=np.float64)
+    return values, np.array([counts[value] for value in values.tolist()], dtype=np.int64)
+
+# El resumen en JSON: los recuentos como dos listas (valores, recuentos)
+def sketch_to_json(sketch):
+    moments = sketch['moments']
+    return {
+        'rows': sketch['rows'],
+        'counts': {col: [list(counts), list(counts.values())] for col, counts in sketch['counts'].items()},
+        'moments': {'n': moments['n'], 'sum': np.asarray(moments['sum']).tolist(), 'products': np.asarray(moments['products']).tolist()} if moments else {}
+    }
+
+def sketch_from_json(data):
+    moments = data['moments']
+    return {
+        'rows': data['rows'],
+        'counts': {col: dict(zip(values, counts)) for col, (values, counts) in data['counts'].items()},
+        'moments': {'n': moments['n'], 'sum': np.array(moments['sum']), 'products': np.array(moments['products'])} if moments else {}
+    }
+
+# Parsear el CSV y volcarlo a la caché en disco en dos pasadas por bloques: la primera
+# cuenta las filas y calcula las medianas, la segunda rellena los valores faltantes con
+# ellas, comprueba el rango de cada columna y la escribe, con su tipo, en un .npy preasignado. La memoria usada
+# depende del tamaño del bloque, no del tamaño del fichero.
+@timed
+def build_dataset_cache(name, chunk_rows=CHUNK_ROWS):
+    mtime = os.path.getmtime(DATA_PATHS[name])
+
+    rows, counts = 0, {}
+    for block in iter_csv_blocks(name, chunk_rows):
+        rows += len(block)
+        for col in block.columns:
+            update_value_counts(counts.setdefault(col, {}), block[col].to_numpy(), column_resolution(name, col))
+    medians = {col: median_from_counts(col_counts) for col, col_counts in counts.items()}
+    # En una columna entera la mediana se redondea para que siga siendo un valor posible
+    for col in medians:
+        if column_dtype(name, col).kind == 'i':
+            medians[col] = float(np.round(medians[col]))
+
+    meta = {
+        'source': DATA_PATHS[name],
+        'source_mtime': mtime,
+        'version': data_hash(name)[:12],
+        'rows': rows,
+        'columns': list(SCHEMAS[name]),
+        'schema': {col: list(spec) for col, spec in SCHEMAS[name].items()},
+        'medians': medians
+    }
+
+    final_dir = os.path.join(CACHE_DIR, name)
+    tmp_dir = final_dir + f'.tmp-{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    columns = {
+        col: np.lib.format.open_memmap(os.path.join(tmp_dir, f'{i}.npy'), mode='w+', dtype=column_dtype(name, col), shape=(rows,))
+        for i, col in enumerate(meta['columns'])
+    }
+    # Resumen de los datos ya limpios, para las comparaciones con la población
+    sketch = empty_sketch()
+    start = 0
+    for block in iter_csv_blocks(name, chunk_rows):
+        stop = start + len(block)
+        filled = {}
+        for col, column in columns.items():
+            values = block[col].to_numpy()
+            values = np.where(np.isnan(values), np.float32(medians[col]), values)
+            _, low, high = SCHEMAS[name][col]
+            out_of_range = np.count_nonzero((values < low) | (values > high))
+            if out_of_range:
+                raise ValueError(f"{name}: {out_of_range} valores de {col} fuera del rango [{low}, {high}]")
+            if column.dtype.kind == 'i' and np.any(values != np.round(values)):
+                raise ValueError(f"{name}: la columna {col} tiene valores no enteros")
+            column[start:stop] = values
+            filled[col] = values
+        update_sketch(sketch, name, filled)
+        start = stop
+    for column in columns.values():
+        column.flush()
+    del columns
+    meta['sketch'] = sketch_to_json(sketch)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    # Sustituir la caché anterior con renombrados, sin dejarla nunca a medias
+    old_dir = final_dir + f'.old-{os.getpid()}'
+    try:
+        if os.path.isdir(final_dir):
+            os.replace(final_dir, old_dir)
+        os.replace(tmp_dir, final_dir)
+    except OSError:
+        # Otro proceso ha instalado la suya entre los dos renombrados (sin fcntl no hay
+        # bloqueo): sale del mismo CSV, así que nos quedamos con esa
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return meta
+
+def _read_cache_meta(name):
+    try:
+        with open(os.path.join(CACHE_DIR, name, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# DataFrame de solo lectura sobre los .npy mapeados en memoria
+def _load_cached_frame(name, meta):
+    import pandas as pd
+    path = os.path.join(CACHE_DIR, name)
+    columns = {
+        col: np.load(os.path.join(path, f'{i}.npy'), mmap_mode='r')
+        for i, col in enumerate(meta['columns'])
+    }
+    return pd.DataFrame(columns, copy=False)
+
+# Metadatos y DataFrame de la caché en disco si está al día con el CSV (None si no lo
+# está o si otro proceso la está sustituyendo mientras se lee)
+def _load_current_cache(name, mtime):
+    meta = _read_cache_meta(name)
+    schema = {col: list(spec) for col, spec in SCHEMAS[name].items()}
+    if meta is None or meta['source_mtime'] != mtime or meta.get('schema') != schema or 'sketch' not in meta:
+        return None
+    try:
+        return meta, _load_cached_frame(name, meta)
+    except FileNotFoundError:
+        return None
+
+# Devuelve el conjunto de datos limpio desde la caché; solo vuelve a leer
+# el CSV si su fecha de modificación ha cambiado. Si hay que reconstruirla, lo hace un
+# solo proceso a la vez y el resto usa la que deja
+def get_dataset(name):
+    mtime = os.path.getmtime(DATA_PATHS[name])
+    cached = _DATASETS.get(name)
+    if cached is not None and cached[0] == mtime:
+        return cached[2]
+
+    with _DATASETS_LOCK:
+        cached = _DATASETS.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[2]
+        loaded = _load_current_cache(name, mtime)
+        if loaded is None:
+            with file_lock(os.path.join(CACHE_DIR, f'{name}.lock')):
+                loaded = _load_current_cache(name, mtime)
+                if loaded is None:
+                    meta = build_dataset_cache(name)
+                    loaded = meta, _load_cached_frame(name, meta)
+        meta, df = loaded
+        _DATASETS[name] = (mtime, meta['version'], df, sketch_from_json(meta['sketch']))
+        return df
+
+def get_datasets():
+    return get_dataset('diabetes'), get_dataset('hypertension')
+
+# Versión del conjunto de datos en caché (hash del CSV de origen)
+def dataset_version(name):
+    get_dataset(name)
+    return _DATASETS[name][1]
+
+# Resumen combinable del conjunto de datos limpio (ver empty_sketch)
+def dataset_sketch(name):
+    get_dataset(name)
+    return _DATASETS[name][3]
+
 # Crear un DataFrame con los nombres de las columnas
 def prepare_patient_data_with_names(patient_data, feature_names):
+    import pandas as pd
     return pd.DataFrame([patient_data], columns=feature_names)
 
+# Categoría de edad de un único paciente (None si la edad no es válida);
+# para muchos pacientes a la vez usar src.features.age_groups
 def categorizar_edad(edad):
-    # Diccionario que mapea la categoría con el rango de edad
-    categorias = {
-        1: '0-24',
-        2: '25-29',
-        3: '30-34',
-        4: '35-39',
-        5: '40-44',
-        6: '45-49',
-        7: '50-54',
-        8: '55-59',
-        9: '60-64',
-        10: '65-69',
-        11: '70-74',
-        12: '75-79',
-        13: '80 o más'
-    }
-    
-    # Comparar la edad del paciente y devolver la categoría adecuada
-    if 0 <= edad <= 24:
-        return 1
-    elif 25 <= edad <= 29:
-        return 2
-    elif 30 <= edad <= 34:
-        return 3
-    elif 35 <= edad <= 39:
-        return 4
-    elif 40 <= edad <= 44:
-        return 5
-    elif 45 <= edad <= 49:
-        return 6
-    elif 50 <= edad <= 54:
-        return 7
-    elif 55 <= edad <= 59:
-        return 8
-    elif 60 <= edad <= 64:
-        return 9
-    elif 65 <= edad <= 69:
-        return 10
-    elif 70 <= edad <= 74:
-        return 11
-    elif 75 <= edad <= 79:
-        return 12
-    elif edad >= 80:
-        return 13
-    else:
-        return None  # Una edad fuera de los rangos esperados
-    
\ No newline at end of file
+    grupo = age_groups(edad)
+    return None if np.isnan(grupo) else int(grupo)
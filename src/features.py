@@ -0,0 +1,97 @@
+import numpy as np
+
+# Variables con las que se entrena cada modelo y su variable objetivo.
+# Es la única definición: la usan el entrenamiento, la app y la puntuación masiva.
+FEATURES = {
+    'diabetes': ['BMI', 'Age', 'GenHlth'],
+    'hypertension': ['cp', 'thalach', 'oldpeak']
+}
+TARGETS = {
+    'diabetes': 'Diabetes',
+    'hypertension': 'target'
+}
+
+# Nombre de cada variable en la explicación de los riesgos del paciente
+FEATURE_LABELS = {
+    'BMI': 'BMI',
+    'Age': 'Edad',
+    'GenHlth': 'Salud general',
+    'cp': 'Tipo de dolor de pecho',
+    'thalach': 'Frecuencia cardíaca máxima (según la edad)',
+    'oldpeak': 'Dolor u opresión al hacer ejercicio'
+}
+
+# Rejilla de entradas alcanzables de cada modelo para la tabla de consulta
+# (src.model.build_lookup_table): (inicio, paso, número de valores) por variable,
+# en el orden de FEATURES. Los valores fuera de la rejilla se puntúan con el bosque.
+LOOKUP_GRIDS = {
+    # BMI de 10 a 100 en pasos de 0.1, categoría de edad 1-13, salud general 1-5
+    'diabetes': [(10, 0.1, 901), (1, 1, 13), (1, 1, 5)],
+    # Tipo de dolor 0-3, thalach = 200 - edad para edades enteras de 18 a 130, oldpeak de 0 a 6 en pasos de 0.1
+    'hypertension': [(0, 1, 4), (70, 1, 113), (0, 0.1, 61)]
+}
+
+# Edad a partir de la cual empieza cada categoría de edad del conjunto de diabetes:
+# 1 = 0-24, 2 = 25-29, 3 = 30-34, ..., 12 = 75-79, 13 = 80 o más
+AGE_GROUP_STARTS = np.array([25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80])
+
+# Categoría de edad de un array de edades (NaN para edades negativas o vacías)
+def age_groups(edades):
+    edades = np.asarray(edades, dtype=float)
+    grupos = np.searchsorted(AGE_GROUP_STARTS, edades, side='right') + 1.0
+    return np.where(edades >= 0, grupos, np.nan)
+
+# Matrices de entrada de los dos modelos a partir de los datos del formulario
+# (escalares para un paciente o arrays para muchos), en el orden de FEATURES
+def model_inputs(age, bmi, health, chest_pain, pain):
+    age = np.atleast_1d(np.asarray(age, dtype=float))
+    return {
+        'diabetes': np.column_stack(np.broadcast_arrays(bmi, age_groups(age), health)).astype(float),
+        'hypertension': np.column_stack(np.broadcast_arrays(chest_pain, 200 - age, pain)).astype(float)
+    }
+
+# Pacientes de referencia (edad, BMI, salud general, tipo de dolor, oldpeak) con los que
+# se comprueba un modelo nuevo antes de servirlo (src.model.validate_golden). Incluye
+# valores fuera de la rejilla de consulta para probar también el recorrido del bosque.
+GOLDEN_PATIENTS = [
+    (18, 18.5, 1, 0, 0.0),
+    (29, 22.0, 2, 3, 0.4),
+    (45, 27.5, 3, 1, 2.3),
+    (52, 33.33, 2, 2, 1.15),
+    (60, 31.2, 4, 2, 3.5),
+    (67, 41.8, 5, 0, 1.9),
+    (74, 25.05, 4, 3, 4.2),
+    (88, 38.0, 5, 1, 6.0)
+]
+
+# Matrices de entrada de los pacientes de referencia, como model_inputs
+def golden_inputs():
+    return model_inputs(*(np.array(column) for column in zip(*GOLDEN_PATIENTS)))
+
+# Registro compacto de un paciente que se guarda en el navegador (dcc.Store): datos
+# del formulario, variables derivadas y las probabilidades ya calculadas, con su tipo
+PATIENT_SCHEMA = {
+    'age': float,
+    'bmi': float,
+    'health': int,
+    'chest_pain': int,
+    'pain': float,
+    'age_group': int,
+    'thalach': float,
+    'diabetes_prob': float,
+    'hypertension_prob': float
+}
+
+def patient_record(age, bmi, health, chest_pain, pain, diabetes_prob, hypertension_prob):
+    values = {
+        'age': age,
+        'bmi': bmi,
+        'health': health,
+        'chest_pain': chest_pain,
+        'pain': pain,
+        'age_group': age_groups(age),
+        'thalach': 200 - age,
+        'diabetes_prob': diabetes_prob,
+        'hypertension_prob': hypertension_prob
+    }
+    return {field: cast(values[field]) for field, cast in PATIENT_SCHEMA.items()}
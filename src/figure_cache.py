@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from src.metrics import span
+from src.serialize import figure_json, loads
+from src.tasks import task_pool
+
+# Caché LRU de figuras ya serializadas a JSON, compartida por todos los callbacks.
+# La clave debe incluir todo aquello de lo que depende la figura, por ejemplo
+# (tipo de gráfico, versión de los datos, versión del modelo, tamaño). El tipo de
+# gráfico va primero: decide los decimales con que se serializa (src.serialize).
+class FigureCache:
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Devuelve la figura (como dict) para la clave; si no está, la construye con build()
+    def get(self, key, build):
+        serialized = self.submit(key, build).result()
+        with span('figure.from_json'):
+            return loads(serialized)
+
+    # Varias figuras a la vez: {nombre: (clave, build)} -> {nombre: figura}.
+    # Las que faltan se construyen en paralelo en el pool de tareas
+    def get_many(self, requests):
+        futures = {name: self.submit(key, build) for name, (key, build) in requests.items()}
+        serialized = {name: future.result() for name, future in futures.items()}
+        with span('figure.from_json'):
+            return {name: loads(value) for name, value in serialized.items()}
+
+    # Future con la figura serializada. Si no está en la caché se construye en el
+    # pool de tareas, y las peticiones simultáneas de la misma clave esperan a una
+    # sola construcción en lugar de repetirla
+    def submit(self, key, build):
+        with self._lock:
+            serialized = self._entries.get(key)
+            if serialized is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(serialized)
+                return future
+            self.misses += 1
+        return task_pool.submit(('figure', key), self._build, key, build)
+
+    def _build(self, key, build):
+        fig = build()
+        with span('figure.to_json'):
+            serialized = figure_json(fig, key[0])
+        self.put(key, serialized)
+        return serialized
+
+    def put(self, key, serialized):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= len(self._entries.pop(key))
+            self._entries[key] = serialized
+            self._bytes += len(serialized)
+            # Expulsar las menos usadas hasta respetar los límites
+            while len(self._entries) > self.max_entries or (self._bytes > self.max_bytes and len(self._entries) > 1):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+# Instancia única del proceso
+figure_cache = FigureCache()
@@ -1,8 +1,11 @@
 from plotly.graph_objects import Figure, Indicator
-import plotly.express as px
 import plotly.graph_objects as go
 import numpy as np
+from src.metrics import span, timed
 
+# plotly.express y pandas se importan dentro de las funciones que los usan, no al arrancar
+
+@timed
 def create_gauge_chart(probability, title="Nivel de Riesgo"):
     fig = Figure()
 
@@ -32,7 +35,9 @@ def create_gauge_chart(probability, title="Nivel de Riesgo"):
     )
     return fig
 
+@timed
 def plot_feature_importance(features, importances, title="Importancia de las Variables"):
+    import plotly.express as px
     sorted_data = sorted(zip(importances, features), reverse=True)
     importances, features = zip(*sorted_data)
     
@@ -62,9 +67,19 @@ def plot_feature_importance(features, importances, title="Importancia de las Var
     return fig
 
 
+@timed
 def plot_heatmap(data, features, title="Relación entre Variables"):
     # Crear una matriz de correlación
-    correlation_matrix = data[features].corr()
+    with span('graphics.correlation'):
+        correlation_matrix = data[features].corr()
+    return plot_correlation_heatmap(correlation_matrix.values, features, title)
+
+
+# Heatmap a partir de una matriz de correlación ya calculada (p. ej. la del informe del modelo)
+@timed
+def plot_correlation_heatmap(correlation, features, title="Relación entre Variables"):
+    import pandas as pd
+    correlation_matrix = pd.DataFrame(correlation, index=features, columns=features)
 
     fig = go.Figure(data=go.Heatmap(
         z=correlation_matrix.values,
@@ -97,8 +112,25 @@ def plot_heatmap(data, features, title="Relación entre Variables"):
     return fig
 
 
-def plot_histogram_with_patient(data, patient_value, feature, title):
-    counts, bins = np.histogram(data[feature], bins=13)
+# Las gráficas de distribución se dividen en una base con la población (igual para
+# todos los pacientes, se serializa una vez por versión de datos/modelo) y una
+# capa con la línea del paciente, que es la única parte que cambia en cada petición.
+# La línea del paciente es siempre la traza PATIENT_TRACE y sale vacía en la base.
+PATIENT_TRACE = 1
+
+# Cambios que hay que aplicar a la traza del paciente para dibujarlo
+def patient_overlay(patient_value, name='Paciente'):
+    return {'x': [patient_value, patient_value], 'name': name}
+
+def add_patient_overlay(fig, patient_value, name='Paciente'):
+    fig.update_traces(patch=patient_overlay(patient_value, name), selector=PATIENT_TRACE)
+    return fig
+
+# 'weights': recuentos de cada valor, si la población llega resumida (src.etl.sketch_values)
+@timed
+def plot_histogram_base(values, feature, title, weights=None):
+    counts, bins = np.histogram(values, bins=13, weights=weights)
+    counts = counts.astype(np.int64)
 
     hist_fig = go.Figure()
 
@@ -114,9 +146,8 @@ def plot_histogram_with_patient(data, patient_value, feature, title):
         name="Población"
     ))
 
-    patient_val = patient_value[feature].iloc[0]
     hist_fig.add_trace(go.Scatter(
-        x=[patient_val, patient_val], 
+        x=[None, None],
         y=[0, max(counts) * 1.1],  
         mode='lines',
         line=dict(color='red', width=3, dash='dash'),  
@@ -137,10 +168,15 @@ def plot_histogram_with_patient(data, patient_value, feature, title):
 
     return hist_fig
 
+@timed
+def plot_histogram_with_patient(data, patient_value, feature, title):
+    hist_fig = plot_histogram_base(data[feature], feature, title)
+    return add_patient_overlay(hist_fig, patient_value[feature].iloc[0])
 
-def plot_risk_distribution(predicted_probabilities, patient_probability, title="Distribución de Riesgo"):
-    counts, bins = np.histogram(predicted_probabilities, bins=13)
 
+@timed
+def plot_risk_distribution_base(counts, bins, title="Distribución de Riesgo"):
+    # El histograma de la población llega ya calculado (src.model.load_population_stats)
     hist_fig = go.Figure()
 
     hist_fig.add_trace(go.Bar(
@@ -156,7 +192,7 @@ def plot_risk_distribution(predicted_probabilities, patient_probability, title="
     ))
 
     hist_fig.add_trace(go.Scatter(
-        x=[patient_probability, patient_probability],
+        x=[None, None],
         y=[0, max(counts)],  
         mode='lines',
         line=dict(color='red', width=3, dash='dash'),  
@@ -177,7 +213,19 @@ def plot_risk_distribution(predicted_probabilities, patient_probability, title="
 
     return hist_fig
 
-def plot_age_distribution(predicted_ages, patient_age, title="Comparación de su edad con la población"):
+# Nombre de la línea del paciente en la distribución de riesgo
+def risk_patient_name(patient_percentile=None):
+    if patient_percentile is None:
+        return 'Paciente'
+    return f'Paciente (percentil {patient_percentile:.0f})'
+
+@timed
+def plot_risk_distribution(counts, bins, patient_probability, title="Distribución de Riesgo", patient_percentile=None):
+    hist_fig = plot_risk_distribution_base(counts, bins, title)
+    return add_patient_overlay(hist_fig, patient_probability, risk_patient_name(patient_percentile))
+
+@timed
+def plot_age_distribution_base(predicted_ages, title="Comparación de su edad con la población", weights=None):
     # Definir los rangos de edad
     rango_edades = {
         0: '0-18', 1: '18-24', 2: '25-29', 3: '30-34',
@@ -186,7 +234,8 @@ def plot_age_distribution(predicted_ages, patient_age, title="Comparación de su
         12: '75-79', 13: '80+'
     }
 
-    counts, bins = np.histogram(predicted_ages, bins=13)
+    counts, bins = np.histogram(predicted_ages, bins=13, weights=weights)
+    counts = counts.astype(np.int64)
 
     hist_fig = go.Figure()
 
@@ -203,7 +252,7 @@ def plot_age_distribution(predicted_ages, patient_age, title="Comparación de su
     ))
 
     hist_fig.add_trace(go.Scatter(
-        x=[patient_age, patient_age],
+        x=[None, None],
         y=[0, max(counts)],  
         mode='lines',
         line=dict(color='red', width=3, dash='dash'), 
@@ -232,3 +281,8 @@ def plot_age_distribution(predicted_ages, patient_age, title="Comparación de su
     )
 
     return hist_fig
+
+@timed
+def plot_age_distribution(predicted_ages, patient_age, title="Comparación de su edad con la población"):
+    hist_fig = plot_age_distribution_base(predicted_ages, title)
+    return add_patient_overlay(hist_fig, patient_age)
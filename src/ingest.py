@@ -0,0 +1,364 @@
+import argparse
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import numpy as np
+from src.etl import (SCHEMAS, dataset_sketch, dataset_version, empty_sketch, merge_sketches, update_sketch,
+                     sketch_to_json, sketch_from_json, median_from_counts, correlation_from_moments)
+from src.features import FEATURES, model_inputs
+from src.model import predict_risk
+
+# Ingesta de pacientes nuevos (los que aceptan en el formulario que se guarden sus datos,
+# o un CSV con python -m src.ingest). Se añaden a un almacén de segmentos inmutables en
+# SEGMENTS_DIR: cada segmento es un directorio con un .npy por columna y un meta.json con
+# su resumen combinable (src.etl.empty_sketch). La población de referencia de los
+# gráficos es la suma del resumen del CSV y de los resúmenes de los segmentos, así que
+# un segmento nuevo solo obliga a sumar su resumen, no a recorrer todos los datos.
+
+SEGMENTS_DIR = 'src/segments'
+
+# Columnas que se guardan de cada paciente: solo los datos del formulario, sin ningún
+# identificador ni la hora exacta (el nombre del segmento solo fecha el lote)
+RECORD_COLUMNS = {'age': 'float32', 'bmi': 'float32', 'health': 'int8', 'chest_pain': 'int8', 'pain': 'float32'}
+
+# Los pacientes del formulario se acumulan en memoria y se escriben como un segmento
+# cuando hay INGEST_FLUSH_ROWS o cada INGEST_FLUSH_SECONDS (hilo de start_ingest_thread)
+INGEST_FLUSH_ROWS = 256
+INGEST_FLUSH_SECONDS = float(os.environ.get('APPHEALTH_INGEST_SECONDS', '10'))
+
+# Resolución de las probabilidades de los pacientes ingeridos para la distribución de riesgo
+RISK_GRID = 1000
+
+# Columnas de los conjuntos de datos (nombre -> {columna: valores}) que corresponden a
+# unos pacientes del formulario, con la misma transformación que los modelos
+def dataset_columns(columns):
+    inputs = model_inputs(columns['age'], columns['bmi'], columns['health'], columns['chest_pain'], columns['pain'])
+    return {
+        name: {col: inputs[name][:, i] for i, col in enumerate(FEATURES[name])}
+        for name in FEATURES
+    }
+
+# Pacientes válidos: edad mayor de 18, todos los campos y dentro del rango de SCHEMAS
+def valid_rows(columns):
+    valid = np.asarray(columns['age'], dtype=float) >= 18
+    for name, dataset in dataset_columns(columns).items():
+        for col, values in dataset.items():
+            _, low, high = SCHEMAS[name][col]
+            valid &= ~np.isnan(values) & (values >= low) & (values <= high)
+    return valid
+
+# Columnas (RECORD_COLUMNS) de una lista de pacientes, ya filtradas
+def records_to_columns(records):
+    columns = {
+        col: np.array([np.nan if record.get(col) is None else record[col] for record in records], dtype=np.float64)
+        for col in RECORD_COLUMNS
+    }
+    valid = valid_rows(columns)
+    return {col: values[valid].astype(dtype) for (col, values), dtype in zip(columns.items(), RECORD_COLUMNS.values())}
+
+def segment_sketches(columns):
+    sketches = {}
+    for name, dataset in dataset_columns(columns).items():
+        sketch = empty_sketch()
+        update_sketch(sketch, name, dataset)
+        sketches[name] = sketch
+    return sketches
+
+# Escribir un segmento nuevo (directorio temporal + renombrado, como la caché de etl).
+# 'replaces': segmentos que contiene este (compactación)
+def write_segment(columns, replaces=()):
+    rows = len(columns['age'])
+    segment = f'{time.time_ns():020d}-{os.getpid()}'
+    os.makedirs(SEGMENTS_DIR, exist_ok=True)
+    tmp_dir = os.path.join(SEGMENTS_DIR, f'.tmp-{segment}')
+    os.makedirs(tmp_dir)
+    for i, col in enumerate(RECORD_COLUMNS):
+        np.save(os.path.join(tmp_dir, f'{i}.npy'), columns[col])
+    meta = {
+        'rows': rows,
+        'columns': list(RECORD_COLUMNS),
+        'replaces': list(replaces),
+        'sketch': {name: sketch_to_json(sketch) for name, sketch in segment_sketches(columns).items()}
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_dir, os.path.join(SEGMENTS_DIR, segment))
+    return segment
+
+# Añadir pacientes al almacén; devuelve el segmento escrito (None si ninguno es válido)
+def append_records(records):
+    columns = records_to_columns(records)
+    if not len(columns['age']):
+        return None
+    return write_segment(columns)
+
+def list_segments():
+    try:
+        return sorted(name for name in os.listdir(SEGMENTS_DIR) if not name.startswith('.'))
+    except FileNotFoundError:
+        return []
+
+def read_segment_meta(segment):
+    with open(os.path.join(SEGMENTS_DIR, segment, 'meta.json')) as f:
+        return json.load(f)
+
+def load_segment(segment):
+    meta = read_segment_meta(segment)
+    path = os.path.join(SEGMENTS_DIR, segment)
+    return {col: np.load(os.path.join(path, f'{i}.npy'), mmap_mode='r') for i, col in enumerate(meta['columns'])}
+
+# Pacientes del formulario pendientes de escribir en este proceso
+_PENDING = []
+_PENDING_LOCK = threading.Lock()
+
+def record_patient(record):
+    with _PENDING_LOCK:
+        _PENDING.append({col: record[col] for col in RECORD_COLUMNS})
+        full = len(_PENDING) >= INGEST_FLUSH_ROWS
+    if full:
+        flush()
+
+# Guardar el paciente de un envío del formulario si ha dado su consentimiento. 'previous'
+# es el registro del envío anterior (patient-store): si ya se guardó y los datos del
+# formulario no han cambiado, no se vuelve a contar. Devuelve si el paciente está guardado
+def record_submission(record, previous, consent):
+    if previous and previous.get('ingested') and all(previous.get(col) == record[col] for col in RECORD_COLUMNS):
+        return True
+    if consent:
+        record_patient(record)
+        return True
+    return False
+
+def flush():
+    with _PENDING_LOCK:
+        records = _PENDING[:]
+        _PENDING.clear()
+    if records:
+        return append_records(records)
+    return None
+
+# Al salir del proceso se escriben los pendientes
+atexit.register(flush)
+
+# Estado de la ingesta en este proceso: segmentos ya sumados, su resumen por conjunto de
+# datos y una versión (hash de los segmentos) que forma parte de las claves de las figuras.
+# Se sustituye entero en cada cambio, como los modelos (src.model.get_models)
+_STATE = None
+_STATE_LOCK = threading.Lock()
+
+def state_version(segments):
+    if not segments:
+        return ''
+    return hashlib.sha256('\n'.join(sorted(segments)).encode()).hexdigest()[:12]
+
+def build_state(segments, sketches):
+    return {'segments': frozenset(segments), 'version': state_version(segments), 'sketch': sketches}
+
+# Sumar al estado los segmentos nuevos. Un segmento compactado sustituye a los que
+# contiene: si ya estaban sumados no se vuelve a sumar nada, y si solo lo estaban en
+# parte (o han desaparecido segmentos sin compactar) se recalcula el estado desde cero
+def refresh_state():
+    global _STATE
+    with _STATE_LOCK:
+        state = _STATE or build_state((), {name: empty_sketch() for name in FEATURES})
+        available = list_segments()
+        metas = read_segment_metas(segment for segment in available if segment not in state['segments'])
+        replaced = {old for meta in metas.values() for old in meta['replaces']}
+
+        segments, sketches = set(state['segments']), dict(state['sketch'])
+        for segment, meta in metas.items():
+            if segment in replaced:
+                continue
+            replaces = set(meta['replaces'])
+            if replaces and replaces <= segments:
+                segments = (segments - replaces) | {segment}
+            elif replaces & segments:
+                _STATE = rebuild_state()
+                return _STATE
+            else:
+                segments.add(segment)
+                for name, sketch in meta['sketch'].items():
+                    sketches[name] = merge_sketches(sketches[name], sketch_from_json(sketch))
+        if not segments <= set(available):
+            _STATE = rebuild_state()
+            return _STATE
+        if _STATE is None or segments != state['segments']:
+            _STATE = build_state(segments, sketches)
+        return _STATE
+
+# Los segmentos que desaparecen mientras se leen son los que acaba de sustituir una
+# compactación, que ya está escrita y aparece en el listado
+def read_segment_metas(segments):
+    metas = {}
+    for segment in segments:
+        try:
+            metas[segment] = read_segment_meta(segment)
+        except FileNotFoundError:
+            pass
+    return metas
+
+def rebuild_state():
+    metas = read_segment_metas(list_segments())
+    replaced = {old for meta in metas.values() for old in meta['replaces']}
+    segments = [segment for segment in metas if segment not in replaced]
+    sketches = {name: empty_sketch() for name in FEATURES}
+    for segment in segments:
+        for name, sketch in metas[segment]['sketch'].items():
+            sketches[name] = merge_sketches(sketches[name], sketch_from_json(sketch))
+    return build_state(segments, sketches)
+
+def ingest_state():
+    state = _STATE
+    if state is None:
+        state = refresh_state()
+    return state
+
+# Población de referencia de un conjunto de datos: CSV + pacientes ingeridos
+def with_ingest_version(version):
+    ingested = ingest_state()['version']
+    return version + (f'+{ingested}' if ingested else '')
+
+def population_version(name):
+    return with_ingest_version(dataset_version(name))
+
+# Versión de la distribución de riesgo de un modelo: la del modelo más los pacientes ingeridos
+def risk_population_version(model):
+    return with_ingest_version(model['version'])
+
+def population_sketch(name):
+    return merge_sketches(dataset_sketch(name), ingest_state()['sketch'][name])
+
+# Recuentos de las probabilidades de los pacientes ingeridos con un modelo, en RISK_GRID
+# intervalos. Se guardan por versión del modelo y solo se puntúan los segmentos nuevos
+_RISK = {}
+_RISK_LOCK = threading.Lock()
+
+def ingested_risk_counts(disease, model):
+    try:
+        return score_segments(disease, model, ingest_state())
+    except FileNotFoundError:
+        # Una compactación ha borrado un segmento mientras se leía: ya está en el listado
+        return score_segments(disease, model, refresh_state())
+
+def score_segments(disease, model, state):
+    with _RISK_LOCK:
+        key = (disease, model['version'])
+        segments, counts = _RISK.get(key, (frozenset(), np.zeros(RISK_GRID, dtype=np.int64)))
+        if not segments <= state['segments']:
+            # Hubo una compactación: se vuelve a puntuar todo una vez
+            segments, counts = frozenset(), np.zeros(RISK_GRID, dtype=np.int64)
+        new = state['segments'] - segments
+        if new:
+            counts = counts.copy()
+            for segment in new:
+                columns = {col: np.asarray(values, dtype=float) for col, values in load_segment(segment).items()}
+                X = model_inputs(**columns)[disease]
+                if len(X):
+                    positions = np.minimum((predict_risk(model, X) * RISK_GRID).astype(np.intp), RISK_GRID - 1)
+                    counts += np.bincount(positions, minlength=RISK_GRID)
+            # Solo se guarda la versión actual de cada modelo
+            for old in [old for old in _RISK if old[0] == disease]:
+                del _RISK[old]
+            _RISK[key] = (state['segments'], counts)
+        return counts
+
+# Distribución de riesgo de la población (la del modelo más los pacientes ingeridos, en
+# los mismos intervalos) y percentil de un paciente dentro de ella
+def risk_population(disease, model):
+    base = model['population']
+    counts = ingested_risk_counts(disease, model)
+    if not counts.any():
+        return base['counts'], base['bins']
+    bins = base['bins']
+    centers = (np.arange(RISK_GRID) + 0.5) / RISK_GRID
+    added, _ = np.histogram(np.clip(centers, bins[0], bins[-1]), bins=bins, weights=counts)
+    return base['counts'] + added.astype(base['counts'].dtype), bins
+
+def risk_percentile(disease, model, probability):
+    sorted_probabilities = model['population']['sorted_probabilities']
+    position = np.searchsorted(sorted_probabilities, probability, side='right')
+    counts = ingested_risk_counts(disease, model)
+    below = counts[:min(int(probability * RISK_GRID), RISK_GRID - 1) + 1].sum()
+    return 100.0 * (position + below) / (len(sorted_probabilities) + counts.sum())
+
+# Resumen de la población de referencia (GET /api/population)
+def population_summary():
+    state = ingest_state()
+    summary = {'ingested_segments': len(state['segments'])}
+    for name in FEATURES:
+        sketch = population_sketch(name)
+        summary[name] = {
+            'rows': sketch['rows'],
+            'ingested_rows': state['sketch'][name]['rows'],
+            'medians': {col: median_from_counts(counts) for col, counts in sketch['counts'].items() if col in FEATURES[name]},
+            'correlation': {'features': FEATURES[name], 'matrix': np.round(correlation_from_moments(sketch['moments']), 4).tolist()}
+        }
+    return summary
+
+# Hilo que escribe los pendientes y suma los segmentos de otros procesos. Se arranca
+# en cada worker (gunicorn.conf.py), como el de los modelos
+def start_ingest_thread(log=print, interval=INGEST_FLUSH_SECONDS):
+    if interval <= 0:
+        return None
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                flush()
+                refresh_state()
+            except Exception as e:
+                log(f"Error en la ingesta de pacientes: {e}")
+    thread = threading.Thread(target=run, name='ingest', daemon=True)
+    thread.start()
+    return thread
+
+# Juntar todos los segmentos en uno. Se escribe el nuevo antes de borrar los anteriores
+# y los procesos que ya los tenían sumados no cuentan dos veces sus filas
+def compact():
+    segments = list_segments()
+    if len(segments) < 2:
+        return None
+    parts = [load_segment(segment) for segment in segments]
+    columns = {col: np.concatenate([np.asarray(part[col]) for part in parts]) for col in RECORD_COLUMNS}
+    compacted = write_segment(columns, replaces=segments)
+    for segment in segments:
+        shutil.rmtree(os.path.join(SEGMENTS_DIR, segment), ignore_errors=True)
+    return compacted
+
+# Herramienta de línea de comandos:
+#   python -m src.ingest pacientes.csv [--chunk-size N]
+#   python -m src.ingest --compact
+def main(argv=None):
+    from src.batch import iter_csv_chunks, normalize_inputs
+    parser = argparse.ArgumentParser(description="Añadir pacientes a la población de referencia de AppHealth")
+    parser.add_argument('input', nargs='?', help="CSV con columnas age, bmi, health, chest_pain, pain")
+    parser.add_argument('--chunk-size', type=int, default=100_000, help="Pacientes por segmento")
+    parser.add_argument('--compact', action='store_true', help="Juntar todos los segmentos en uno")
+    args = parser.parse_args(argv)
+    if not args.input and not args.compact:
+        parser.error("indique un CSV o --compact")
+
+    if args.input:
+        added = skipped = 0
+        for chunk in iter_csv_chunks(args.input, args.chunk_size):
+            # Mismos valores por defecto y conversión que la puntuación masiva (src.batch)
+            try:
+                records = normalize_inputs(chunk)[list(RECORD_COLUMNS)].to_dict('records')
+            except ValueError as e:
+                raise SystemExit(str(e))
+            columns = records_to_columns(records)
+            if len(columns['age']):
+                write_segment(columns)
+            added += len(columns['age'])
+            skipped += len(records) - len(columns['age'])
+        print(f"{added} pacientes añadidos, {skipped} descartados por incompletos o fuera de rango")
+    if args.compact:
+        compacted = compact()
+        print(f"Segmentos compactados en {compacted}" if compacted else "No hay segmentos que compactar")
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,945 @@
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import accuracy_score
-from src.etl import load_data  
-
-# Función para entrenar y evaluar un modelo con las variables más importantes
-def train_and_evaluate_model(data, target_column, important_features):
-    # Separar variables independientes (X) y dependientes (y)
-    X = data[important_features]
-    y = data[target_column]
-    
-    # Codificar variables categóricas si es necesario
-    for col in X.select_dtypes(include=['object']).columns:
-        X[col] = LabelEncoder().fit_transform(X[col].astype(str))
-            
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import numpy as np
+from src.etl import load_dataset, data_hash, file_lock, CHUNK_ROWS
+from src.features import FEATURES, TARGETS, LOOKUP_GRIDS, golden_inputs
+from src.metrics import timed
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# sklearn, joblib y pandas se importan dentro de las funciones de entrenamiento: el
+# servidor puntúa con los arrays planos y no necesita cargarlos (arranque más rápido)
+
+# Directorio donde se guardan los modelos entrenados (uno por enfermedad y versión)
+ARTIFACTS_DIR = 'src/artifacts'
+# Modo de inferencia: 'lookup' usa la tabla precalculada cuando la entrada está en la
+# rejilla y el bosque en otro caso; 'forest' usa siempre el bosque
+INFERENCE_MODE = os.environ.get('APPHEALTH_INFERENCE', 'lookup')
+
+# Separar variables y objetivo y dividir en entrenamiento y prueba. Las variables
+# se pasan a float32 (el tipo con el que trabajan los árboles de sklearn, así no
+# hace otra copia al entrenar) y las categóricas se codifican en columnas nuevas,
+# sin modificar una vista de data
+def split_data(data, target_column, important_features):
+    import pandas as pd
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import LabelEncoder
+
+    columns = {}
+    for col in important_features:
+        values = data[col]
+        if not pd.api.types.is_numeric_dtype(values):
+            values = LabelEncoder().fit_transform(values.astype(str))
+        columns[col] = np.asarray(values, dtype=np.float32)
+    X = pd.DataFrame(columns, copy=False)
+    y = data[target_column].to_numpy()
+
     # Dividir datos en entrenamiento y prueba
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=123)
-    
-    # Entrenar un modelo Random Forest
-    rf = RandomForestClassifier(random_state=42)
+    return train_test_split(X, y, test_size=0.3, random_state=123)
+
+# Entrenar un Random Forest usando n_jobs núcleos (params: hiperparámetros elegidos con --tune)
+def fit_forest(X_train, y_train, n_jobs=None, params=None):
+    from sklearn.ensemble import RandomForestClassifier
+    rf = RandomForestClassifier(random_state=42, n_jobs=n_jobs, **(params or {}))
     rf.fit(X_train, y_train)
-    
-    # Evaluar el modelo
-    y_pred = rf.predict(X_test)
-    accuracy = accuracy_score(y_test, y_pred)
-    
-    return rf, accuracy
-
-# Seleccionamos las 3 variables importantes con las que entrenamos el modelo
-diabetes_features_imp = ['BMI', 'Age', 'GenHlth']
-hypertension_features_imp = ['cp', 'thalach', 'oldpeak']
-
-# Función para entrenar modelos con las características seleccionadas
-def train_models():
-    df_diabetes, df_hypertension = load_data()
-
-    diabetes_model, diabetes_accuracy = train_and_evaluate_model(
-        df_diabetes, 'Diabetes', diabetes_features_imp
-    )
+    return rf
 
-    hypertension_model, hypertension_accuracy = train_and_evaluate_model(
-        df_hypertension, 'target', hypertension_features_imp
-    )
+# Informe del modelo calculado al entrenar, para que el dashboard no tenga que
+# hacer ningún cálculo analítico por petición
+def build_model_report(model, data, important_features, X_test, y_test, n_jobs=None):
+    from sklearn.inspection import permutation_importance
+    from sklearn.metrics import accuracy_score, confusion_matrix
+
+    y_pred = model.predict(X_test)
+    permutation = permutation_importance(model, X_test, y_test, n_repeats=5, random_state=42, n_jobs=n_jobs)
+    correlation = data[important_features].corr()
+
+    return {
+        'features': list(important_features),
+        'accuracy': float(accuracy_score(y_test, y_pred)),
+        'feature_importances': [float(v) for v in model.feature_importances_],
+        'permutation_importances': [float(v) for v in permutation.importances_mean],
+        'permutation_importances_std': [float(v) for v in permutation.importances_std],
+        'correlation': correlation.to_numpy().tolist(),
+        'confusion_matrix': {
+            'labels': [float(label) for label in model.classes_],
+            'matrix': confusion_matrix(y_test, y_pred, labels=model.classes_).tolist()
+        }
+    }
+
+# Variable objetivo y variables de cada modelo
+MODEL_SPECS = {disease: (TARGETS[disease], FEATURES[disease]) for disease in FEATURES}
+
+# Número de barras del histograma de riesgo de la población
+POPULATION_BINS = 13
+
+# Puntuar a toda la población una sola vez por versión del modelo
+def compute_population_stats(model, data, features, chunk_rows=CHUNK_ROWS):
+    # Por bloques, para no convertir todo el conjunto de datos a float32 de una vez
+    probabilities = np.concatenate([
+        model.predict_proba(data[features].iloc[start:start + chunk_rows])[:, 1]
+        for start in range(0, len(data), chunk_rows)
+    ])
+    counts, bins = np.histogram(probabilities, bins=POPULATION_BINS)
+    return {
+        'counts': counts,
+        'bins': bins,
+        'sorted_probabilities': np.sort(probabilities)
+    }
+
+# Guardar/cargar un grupo de arrays como .npy sueltos, para poder mapearlos en memoria
+# (se devuelven como ndarray normales sobre el mapa, que se indexan más rápido que np.memmap)
+def save_arrays(path, prefix, arrays):
+    for name, values in arrays.items():
+        # Con el pid: varios procesos pueden estar calculando los mismos arrays a la vez
+        tmp_file = os.path.join(path, f'.{prefix}_{name}.tmp-{os.getpid()}.npy')
+        np.save(tmp_file, values)
+        os.replace(tmp_file, os.path.join(path, f'{prefix}_{name}.npy'))
+
+def load_arrays(path, prefix, names):
+    return {
+        name: np.asarray(np.load(os.path.join(path, f'{prefix}_{name}.npy'), mmap_mode='r'))
+        for name in names
+    }
+
+POPULATION_ARRAYS = ['counts', 'bins', 'sorted_probabilities']
+
+# Estadísticas de población de una versión; se calculan la primera vez si faltan
+def load_population_stats(disease, version):
+    path = artifact_dir(disease, version)
+    if not os.path.isfile(os.path.join(path, 'population_sorted_probabilities.npy')):
+        _, features = MODEL_SPECS[disease]
+        save_arrays(path, 'population', compute_population_stats(load_estimator(disease, version), load_dataset(disease), features))
+    return load_arrays(path, 'population', POPULATION_ARRAYS)
+
+# Exportar un Random Forest ya entrenado a arrays planos de NumPy: todos los
+# nodos de todos los árboles seguidos, con los hijos como índices globales.
+# Las hojas apuntan a sí mismas, así que recorrer 'depth' niveles siempre
+# termina en una hoja sin tener que comprobarlo. 'cover' es el peso de las muestras
+# de entrenamiento que pasan por cada nodo (para las explicaciones, build_explainer).
+def export_forest(model):
+    features, thresholds, lefts, rights, values, covers, roots = [], [], [], [], [], [], []
+    offset = 0
+    depth = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        nodes = np.arange(tree.node_count)
+        is_leaf = tree.children_left == -1
+
+        # Probabilidad de la clase positiva en cada nodo (igual que DecisionTreeClassifier.predict_proba)
+        proba = tree.value[:, 0, :]
+        normalizer = proba.sum(axis=1)
+        normalizer[normalizer == 0.0] = 1.0
+
+        features.append(np.where(is_leaf, 0, tree.feature))
+        thresholds.append(np.where(is_leaf, 0.0, tree.threshold))
+        lefts.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+        rights.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+        values.append(proba[:, 1] / normalizer)
+        covers.append(tree.weighted_n_node_samples)
+        roots.append(offset)
+        offset += tree.node_count
+        depth = max(depth, tree.max_depth)
 
+    index_dtype = np.int32 if offset < 2**31 else np.int64
     return {
-        'diabetes': (diabetes_model, diabetes_accuracy),
-        'hypertension': (hypertension_model, hypertension_accuracy)
+        'feature': np.concatenate(features).astype(np.int32),
+        'threshold': np.concatenate(thresholds).astype(np.float64),
+        'children': np.stack([np.concatenate(lefts), np.concatenate(rights)], axis=1).astype(index_dtype),
+        'value': np.concatenate(values).astype(np.float64),
+        'cover': np.concatenate(covers).astype(np.float64),
+        'roots': np.array(roots, dtype=index_dtype),
+        'depth': np.array(depth)
+    }
+
+FOREST_ARRAYS = ['feature', 'threshold', 'children', 'value', 'cover', 'roots', 'depth']
+
+# Probabilidad de la clase positiva a partir de los arrays planos, sin pandas.
+# X puede ser un vector de variables (un paciente) o una matriz (n_pacientes, n_variables).
+def predict_proba_flat(forest, X):
+    # sklearn compara en float32 contra umbrales float64; hacemos lo mismo
+    X = np.asarray(X, dtype=np.float32)
+    feature, threshold, value = forest['feature'], forest['threshold'], forest['value']
+    # children es (n_nodos, 2): el hijo de 'nodo' es children[2 * nodo + (x > umbral)]
+    children = forest['children'].ravel()
+    depth = int(forest['depth'])
+
+    if X.ndim == 1:
+        nodes = forest['roots']
+        for _ in range(depth):
+            nodes = children.take(2 * nodes + (X.take(feature.take(nodes)) > threshold.take(nodes)))
+        return value.take(nodes).mean()
+
+    # Lote: una fila de nodos por paciente, indexando X ya aplanado
+    n_rows, n_features = X.shape
+    row_offsets = (np.arange(n_rows) * n_features)[:, None]
+    X = X.ravel()
+    nodes = np.broadcast_to(forest['roots'], (n_rows, len(forest['roots'])))
+    for _ in range(depth):
+        nodes = children.take(2 * nodes + (X.take(row_offsets + feature.take(nodes)) > threshold.take(nodes)))
+    return value.take(nodes).mean(axis=1)
+
+# Comprobar que el recorrido plano reproduce las probabilidades de sklearn
+def validate_forest(model, forest, X, tolerance=1e-9):
+    expected = model.predict_proba(X)[:, 1]
+    obtained = predict_proba_flat(forest, np.asarray(X))
+    error = np.max(np.abs(expected - obtained))
+    if error > tolerance:
+        raise ValueError(f"El bosque exportado difiere de sklearn en {error:.3g}")
+    return error
+
+# Arrays planos de una versión; se exportan la primera vez si falta alguno
+# (los artefactos anteriores a las explicaciones no tienen 'cover')
+def load_forest(disease, version):
+    path = artifact_dir(disease, version)
+    if not all(os.path.isfile(os.path.join(path, f'forest_{name}.npy')) for name in FOREST_ARRAYS):
+        save_arrays(path, 'forest', export_forest(load_estimator(disease, version)))
+    return load_arrays(path, 'forest', FOREST_ARRAYS)
+
+# Informe de una versión; si falta (artefactos antiguos) se recalcula con la misma división
+def load_model_report(disease, version):
+    path = os.path.join(artifact_dir(disease, version), 'report.json')
+    if not os.path.isfile(path):
+        target_column, features = MODEL_SPECS[disease]
+        data = load_dataset(disease)
+        _, X_test, _, y_test = split_data(data, target_column, features)
+        report = build_model_report(load_estimator(disease, version), data, features, X_test, y_test)
+        tmp_file = path + f'.tmp-{os.getpid()}'
+        with open(tmp_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmp_file, path)
+    with open(path) as f:
+        return json.load(f)
+
+# Valores de la rejilla en los índices dados, redondeados para que coincidan
+# con lo que se escribe en el formulario (27.3 y no 27.299999999999997)
+def grid_values(grid, index):
+    start, step = grid[:, 0], grid[:, 1]
+    return np.round(start + index * step, 6)
+
+# Todas las combinaciones de la rejilla, en el mismo orden que la tabla aplanada
+def lookup_grid_inputs(grid):
+    sizes = grid[:, 2].astype(int)
+    index = np.stack(np.unravel_index(np.arange(np.prod(sizes)), sizes), axis=1)
+    return grid_values(grid, index)
+
+# Tabla densa con la probabilidad del bosque en cada punto de la rejilla
+def build_lookup_table(disease, forest):
+    grid = np.array(LOOKUP_GRIDS[disease], dtype=np.float64)
+    return {'table': predict_proba_flat(forest, lookup_grid_inputs(grid)), 'grid': grid}
+
+LOOKUP_ARRAYS = ['table', 'grid']
+
+# Posición en la tabla aplanada de cada fila de X y si la fila cae en la rejilla
+# (se compara en float32, como el bosque)
+def lookup_index(grid, X):
+    sizes = grid[:, 2].astype(np.intp)
+    with np.errstate(invalid='ignore'):
+        index = np.rint((X - grid[:, 0]) / grid[:, 1])
+        on_grid = ((index >= 0) & (index < sizes) &
+                   (grid_values(grid, index).astype(np.float32) == X.astype(np.float32))).all(axis=1)
+    index = np.where(on_grid[:, None], index, 0).astype(np.intp)
+    return np.ravel_multi_index(index.T, sizes), on_grid
+
+# Probabilidad desde la tabla para las filas que caen en la rejilla y desde el bosque para el resto
+def lookup_proba(lookup, forest, X):
+    X = np.asarray(X, dtype=np.float64)
+    single = X.ndim == 1
+    X = np.atleast_2d(X)
+    position, on_grid = lookup_index(lookup['grid'], X)
+    result = lookup['table'].take(position)
+    if not on_grid.all():
+        result[~on_grid] = predict_proba_flat(forest, X[~on_grid])
+    return result[0] if single else result
+
+# Comprobar que la tabla devuelve exactamente lo mismo que el bosque en toda la rejilla
+def validate_lookup(lookup, forest):
+    X = lookup_grid_inputs(lookup['grid'])
+    position, on_grid = lookup_index(lookup['grid'], X)
+    if not on_grid.all():
+        raise ValueError(f"{np.count_nonzero(~on_grid)} puntos de la rejilla no se reconocen como tales")
+    mismatches = np.count_nonzero(lookup['table'].take(position) != predict_proba_flat(forest, X))
+    if mismatches:
+        raise ValueError(f"La tabla de consulta difiere del bosque en {mismatches} puntos")
+
+# Tabla de consulta de una versión; se calcula la primera vez si falta
+def load_lookup(disease, version, forest):
+    path = artifact_dir(disease, version)
+    if not os.path.isfile(os.path.join(path, 'lookup_table.npy')):
+        lookup = build_lookup_table(disease, forest)
+        validate_lookup(lookup, forest)
+        save_arrays(path, 'lookup', lookup)
+    return load_arrays(path, 'lookup', LOOKUP_ARRAYS)
+
+# Probabilidad de la clase positiva con el modo de inferencia configurado
+@timed
+def predict_risk(model, X):
+    if INFERENCE_MODE == 'lookup' and model.get('lookup') is not None:
+        return lookup_proba(model['lookup'], model['forest'], X)
+    return predict_proba_flat(model['forest'], X)
+
+# Explicación de cada predicción: cuánto sube o baja cada variable la probabilidad del
+# paciente respecto a la media de la población de entrenamiento ('base'). Son valores de
+# Shapley exactos del juego que usa TreeSHAP: v(S) es la probabilidad esperada conociendo
+# solo las variables de S, siguiendo al paciente en los nodos que dividen por una variable
+# de S y repartiendo según la cobertura de cada hijo en el resto. Con pocas variables se
+# calculan los 2**F subconjuntos directamente. Cada hoja es una caja (inferior, superior]
+# por variable, así que
+#   v(S) = suma, sobre las hojas cuya caja contiene al paciente en las variables de S, de
+#          valor / n_árboles * producto de las fracciones de cobertura de las divisiones por variables fuera de S
+# y el segundo factor no depende del paciente: se guarda por subconjunto y hoja ('weights').
+
+# Cajas de las hojas del bosque (F, n_hojas) y producto de las fracciones de cobertura de
+# las divisiones por cada variable en el camino hasta cada hoja
+def forest_leaf_boxes(forest, n_features):
+    feature, threshold, cover, children = forest['feature'], forest['threshold'], forest['cover'], forest['children']
+    n_nodes = len(feature)
+    lower = np.full((n_nodes, n_features), -np.inf)
+    upper = np.full((n_nodes, n_features), np.inf)
+    ratio = np.ones((n_nodes, n_features))
+    # Nivel a nivel desde las raíces: cada hijo hereda la caja del padre y la recorta
+    nodes = np.asarray(forest['roots'])
+    while len(nodes):
+        nodes = nodes[children[nodes, 0] != nodes]
+        split_feature, split_threshold = feature[nodes], threshold[nodes]
+        for side in (0, 1):
+            child = children[nodes, side]
+            lower[child], upper[child], ratio[child] = lower[nodes], upper[nodes], ratio[nodes]
+            if side == 0:
+                upper[child, split_feature] = np.minimum(upper[child, split_feature], split_threshold)
+            else:
+                lower[child, split_feature] = np.maximum(lower[child, split_feature], split_threshold)
+            ratio[child, split_feature] *= cover[child] / cover[nodes]
+        nodes = children[nodes].ravel()
+    leaves = np.flatnonzero(children[:, 0] == np.arange(n_nodes))
+    # Una fila contigua por variable
+    return leaves, np.ascontiguousarray(lower[leaves].T), np.ascontiguousarray(upper[leaves].T), ratio[leaves].T
+
+# Matriz (2**F, F) que convierte los v(S) en valores de Shapley (phi = v @ matriz).
+# El subconjunto S es una máscara de bits: la variable k está en S si el bit k vale 1
+def shapley_matrix(n_features):
+    from math import factorial
+    matrix = np.zeros((2 ** n_features, n_features))
+    for k in range(n_features):
+        for subset in range(2 ** n_features):
+            if subset >> k & 1:
+                continue
+            size = bin(subset).count('1')
+            weight = factorial(size) * factorial(n_features - size - 1) / factorial(n_features)
+            matrix[subset | 1 << k, k] += weight
+            matrix[subset, k] -= weight
+    return matrix
+
+# Cortes de cada variable en las cajas de las hojas (una fila por variable, rellena con
+# infinito): las hojas que contienen a un paciente solo dependen del intervalo entre
+# cortes en que cae cada variable, así que basta explicar un punto por intervalo. El
+# bosque compara en float32, así que cada corte se baja al mayor float32 que no lo
+# supera (las comparaciones no cambian y los cortes sin un float32 entre medias se juntan)
+def leaf_edges(lower, upper):
+    edges = []
+    for k in range(len(lower)):
+        bounds = np.concatenate([lower[k], upper[k]])
+        bounds = bounds[np.isfinite(bounds)]
+        rounded = bounds.astype(np.float32)
+        rounded = np.where(rounded > bounds, np.nextafter(rounded, np.float32(-np.inf)), rounded)
+        edges.append(np.unique(rounded.astype(np.float64)))
+    padded = np.full((len(edges), max(len(e) for e in edges)), np.inf)
+    for k, e in enumerate(edges):
+        padded[k, :len(e)] = e
+    return padded
+
+# Intervalo de cada variable de uno o varios pacientes (el bosque compara en float32)
+def edge_index(edges, X):
+    X = np.atleast_2d(np.asarray(X, dtype=np.float32)).astype(np.float64)
+    sizes = np.isfinite(edges).sum(axis=1) + 1
+    bins = [np.searchsorted(edges[k], X[:, k], side='left') for k in range(len(edges))]
+    return np.ravel_multi_index(bins, sizes)
+
+# Un punto por intervalo: el propio corte (x <= corte) y, tras el último, infinito
+def edge_points(edges):
+    return [np.append(e[np.isfinite(e)], np.inf) for e in edges]
+
+def axes_inputs(axes):
+    return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, len(axes))
+
+# v(S) en todos los puntos de una rejilla (un eje por variable) sin puntuar punto a
+# punto: sobre las variables de S es una suma de cajas, que se acumula con un array de
+# diferencias (un +/- peso en cada esquina de cada caja) y sumas acumuladas por eje
+def subset_values(axes, lower, upper, weights):
+    sizes = [len(axis) for axis in axes]
+    n_features = len(sizes)
+    # Índices [inicio, fin) de la rejilla dentro de cada caja
+    starts = [np.searchsorted(axes[k], lower[k], side='right') for k in range(n_features)]
+    ends = [np.searchsorted(axes[k], upper[k], side='right') for k in range(n_features)]
+
+    values = np.empty([2 ** n_features] + sizes)
+    for subset in range(2 ** n_features):
+        dims = [k for k in range(n_features) if subset >> k & 1]
+        shape = [sizes[k] + 1 for k in dims]
+        diff = np.zeros(int(np.prod(shape)))
+        for corner in range(2 ** len(dims)):
+            index = [ends[k] if corner >> i & 1 else starts[k] for i, k in enumerate(dims)]
+            position = np.ravel_multi_index(index, shape) if dims else np.zeros(len(weights[subset]), dtype=np.intp)
+            sign = -1.0 if bin(corner).count('1') % 2 else 1.0
+            diff += np.bincount(position, weights=sign * weights[subset], minlength=len(diff))
+        diff = diff.reshape(shape)
+        for axis in range(len(dims)):
+            diff = np.cumsum(diff, axis=axis)
+        diff = diff[tuple(slice(0, sizes[k]) for k in dims)]
+        values[subset] = diff.reshape([sizes[k] if k in dims else 1 for k in range(n_features)])
+    return values.reshape(2 ** n_features, -1)
+
+# Arrays de la explicación de un bosque: cajas de las hojas, pesos por subconjunto y
+# hoja, media de la población ('base'), cortes de cada variable ('edges') y valores de
+# Shapley de un punto por combinación de intervalos ('table', índice de edge_index)
+def build_explainer(disease, forest):
+    n_features = len(LOOKUP_GRIDS[disease])
+    leaves, lower, upper, ratio = forest_leaf_boxes(forest, n_features)
+    weights = (forest['value'][leaves] / len(forest['roots']))[None, :]
+    for k in range(n_features):
+        # Sin la variable k en S (bit 0) se aplica su fracción de cobertura; con ella, la caja
+        weights = np.concatenate([weights * ratio[k], weights])
+    edges = leaf_edges(lower, upper)
+    table = subset_values(edge_points(edges), lower, upper, weights).T @ shapley_matrix(n_features)
+    return {'lower': lower, 'upper': upper, 'weights': weights, 'base': np.array(weights[0].sum()),
+            'edges': edges, 'table': table}
+
+EXPLAIN_ARRAYS = ['lower', 'upper', 'weights', 'base', 'edges', 'table']
+
+# Valores de Shapley (n_pacientes, F) a partir de las cajas de las hojas, para cualquier entrada
+def explain_flat(explainer, X):
+    # El bosque compara en float32
+    X = np.atleast_2d(np.asarray(X, dtype=np.float32)).astype(np.float64)
+    lower, upper, weights = explainer['lower'], explainer['upper'], explainer['weights']
+    n_features = len(lower)
+    values = np.empty((len(X), 2 ** n_features))
+    values[:, 0] = explainer['base']
+    for row, x in enumerate(X):
+        inside = [(x[k] > lower[k]) & (x[k] <= upper[k]) for k in range(n_features)]
+        # Hojas cuya caja contiene al paciente en las variables de S: las de S sin su bit
+        # más bajo, filtradas por esa variable (son pocas, así que se suman con índices)
+        leaves = [None]
+        for subset in range(1, 2 ** n_features):
+            lowest = (subset & -subset).bit_length() - 1
+            rest = subset & (subset - 1)
+            leaves.append(np.flatnonzero(inside[lowest]) if not rest else leaves[rest][inside[lowest][leaves[rest]]])
+            values[row, subset] = weights[subset].take(leaves[subset]).sum()
+    return values @ shapley_matrix(n_features)
+
+# Comprobar la explicación: cada punto de la tabla cae en su propio intervalo, la base
+# más las contribuciones da la probabilidad del bosque en toda la tabla y para los
+# pacientes de referencia (cajas), y las cajas dan lo mismo que la tabla en una muestra
+def validate_explainer(explainer, forest, X, tolerance=1e-9):
+    points = axes_inputs(edge_points(explainer['edges']))
+    if not np.array_equal(edge_index(explainer['edges'], points), np.arange(len(points))):
+        raise ValueError("Los puntos de la tabla de explicaciones no caen en su intervalo")
+    error = np.abs(explainer['base'] + explainer['table'].sum(axis=1) - predict_proba_flat(forest, points)).max()
+    if error > tolerance:
+        raise ValueError(f"Las explicaciones de la tabla no suman la probabilidad: error {error:.3g}")
+    error = np.abs(explainer['base'] + explain_flat(explainer, X).sum(axis=1) - predict_proba_flat(forest, X)).max()
+    if error > tolerance:
+        raise ValueError(f"Las explicaciones no suman la probabilidad: error {error:.3g}")
+    sample = np.linspace(0, len(points) - 1, 64).astype(np.intp)
+    error = np.abs(explain_flat(explainer, points[sample]) - explainer['table'][sample]).max()
+    if error > tolerance:
+        raise ValueError(f"Las explicaciones de la tabla difieren de las de las hojas: error {error:.3g}")
+
+# Explicación de una versión; se calcula la primera vez si falta (o si es de antes de la
+# tabla por intervalos)
+def load_explainer(disease, version, forest):
+    path = artifact_dir(disease, version)
+    if not os.path.isfile(os.path.join(path, 'explain_edges.npy')):
+        explainer = build_explainer(disease, forest)
+        validate_explainer(explainer, forest, golden_inputs()[disease])
+        save_arrays(path, 'explain', explainer)
+    return load_arrays(path, 'explain', EXPLAIN_ARRAYS)
+
+# Contribución de cada variable (en el orden de FEATURES) a la probabilidad de uno o
+# varios pacientes: desde la tabla por intervalos, que es exacta para cualquier entrada
+@timed
+def explain_risk(model, X):
+    explainer = model['explainer']
+    X = np.asarray(X, dtype=np.float64)
+    single = X.ndim == 1
+    X = np.atleast_2d(X)
+    if INFERENCE_MODE == 'lookup':
+        result = explainer['table'][edge_index(explainer['edges'], X)]
+    else:
+        result = explain_flat(explainer, X)
+    return result[0] if single else result
+
+# La versión de un modelo se deriva del hash de sus datos de entrenamiento y,
+# si se han ajustado, de sus hiperparámetros
+def model_version(hash_datos, params=None):
+    if not params:
+        return hash_datos[:12]
+    return hashlib.sha256((hash_datos + json.dumps(params, sort_keys=True)).encode()).hexdigest()[:12]
+
+# Versión que corresponde a los datos y los hiperparámetros actuales
+def current_version(disease):
+    return model_version(data_hash(disease), load_model_params(disease))
+
+def artifact_dir(disease, version):
+    return os.path.join(ARTIFACTS_DIR, disease, version)
+
+# Memoria máxima (RSS) usada por el proceso hasta ahora, en MB
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo da en KB y macOS en bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+# Memoria del proceso en MB según /proc/self/smaps_rollup (Linux): 'rss' cuenta entera
+# cada página que el proceso tiene mapeada, 'pss' reparte las compartidas entre los
+# procesos que las usan y 'private' es lo que solo tiene este proceso
+def memory_usage_mb():
+    usage = {'peak_rss': peak_rss_mb()}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            values = {}
+            for line in f:
+                key, _, rest = line.partition(':')
+                if rest.strip().endswith('kB'):
+                    values[key] = int(rest.split()[0]) / 1024
+    except OSError:
+        return usage
+    usage.update(
+        rss=values['Rss'],
+        pss=values['Pss'],
+        shared=values['Shared_Clean'] + values['Shared_Dirty'],
+        private=values['Private_Clean'] + values['Private_Dirty']
+    )
+    return usage
+
+# Poner a cero el pico de RSS del proceso (VmHWM), para medir cada etapa por separado
+# (Linux: escribir 5 en /proc/self/clear_refs)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def proc_status_mb(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) / 1024
+    return None
+
+# Registrar tiempo y memoria de cada etapa del entrenamiento: la RSS al empezar y su
+# máximo durante la etapa. Donde no se puede reiniciar el pico de RSS se usa
+# tracemalloc, que solo cuenta lo que reservan Python y numpy ('memory' lo indica)
+@contextmanager
+def training_stage(stages, name):
+    rss = reset_peak_rss()
+    if rss:
+        start_mb = proc_status_mb('VmRSS')
+    else:
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start_mb = tracemalloc.get_traced_memory()[0] / 2 ** 20
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    if rss:
+        peak_mb = proc_status_mb('VmHWM')
+    else:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        if not tracing:
+            tracemalloc.stop()
+    stages.append({'stage': name, 'seconds': round(seconds, 3), 'memory': 'rss' if rss else 'tracemalloc',
+                   'start_mb': round(start_mb, 1), 'peak_mb': round(peak_mb, 1)})
+
+# Entrenar un modelo y guardarlo en disco junto con sus metadatos.
+# Devuelve los metadatos (incluidos los tiempos de cada etapa), no el modelo.
+def train_and_save_model(disease, overwrite=False, n_jobs=None):
+    target_column, features = MODEL_SPECS[disease]
+    stages = []
+
+    params = load_model_params(disease)
+    # pandas y sklearn se importan aquí a propósito (el servidor no los necesita): en su
+    # propia etapa, para que su tiempo no se cuente en la primera etapa que los use
+    with training_stage(stages, 'import'):
+        import joblib
+        import pandas
+        import sklearn.ensemble
+        import sklearn.inspection
+        import sklearn.metrics
+        import sklearn.model_selection
+        import sklearn.preprocessing
+    with training_stage(stages, 'hash'):
+        hash_datos = data_hash(disease)
+        version = model_version(hash_datos, params)
+    with training_stage(stages, 'load'):
+        data = load_dataset(disease)
+    with training_stage(stages, 'split'):
+        X_train, X_test, y_train, y_test = split_data(data, target_column, features)
+    with training_stage(stages, 'fit'):
+        model = fit_forest(X_train, y_train, n_jobs, params)
+    with training_stage(stages, 'report'):
+        report = build_model_report(model, data, features, X_test, y_test, n_jobs=n_jobs)
+    with training_stage(stages, 'population'):
+        population = compute_population_stats(model, data, features)
+    with training_stage(stages, 'export'):
+        forest = export_forest(model)
+        validate_forest(model, forest, X_test.iloc[:5000])
+        golden = predict_proba_flat(forest, golden_inputs()[disease]).tolist()
+    with training_stage(stages, 'lookup'):
+        lookup = build_lookup_table(disease, forest)
+        validate_lookup(lookup, forest)
+    with training_stage(stages, 'explain'):
+        explainer = build_explainer(disease, forest)
+        validate_explainer(explainer, forest, golden_inputs()[disease])
+
+    # Escribimos en un directorio temporal y lo renombramos al final,
+    # para que ningún worker vea nunca un artefacto a medio escribir
+    final_dir = artifact_dir(disease, version)
+    tmp_dir = final_dir + f'.tmp-{os.getpid()}'
+    with training_stage(stages, 'save'):
+        os.makedirs(tmp_dir, exist_ok=True)
+        # En el servidor el modelo se usa en un solo hilo
+        model.set_params(n_jobs=None)
+        import joblib
+        joblib.dump(model, os.path.join(tmp_dir, 'model.joblib'))
+        with open(os.path.join(tmp_dir, 'report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        save_arrays(tmp_dir, 'population', population)
+        save_arrays(tmp_dir, 'forest', forest)
+        save_arrays(tmp_dir, 'lookup', lookup)
+        save_arrays(tmp_dir, 'explain', explainer)
+
+    meta = {
+        'disease': disease,
+        'version': version,
+        'data_hash': hash_datos,
+        'target': target_column,
+        'features': features,
+        'params': params,
+        'accuracy': report['accuracy'],
+        'golden': golden,
+        'trained_at': datetime.now(timezone.utc).isoformat(),
+        'training_stages': stages
     }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    # Un solo proceso a la vez instala la versión (otros workers o src.train pueden estar
+    # entrenando la misma)
+    with file_lock(final_dir + '.lock'):
+        old_dir = final_dir + f'.old-{os.getpid()}'
+        try:
+            if os.path.isdir(final_dir) and overwrite:
+                os.replace(final_dir, old_dir)
+            os.replace(tmp_dir, final_dir)
+        except OSError:
+            # Otro proceso ya la ha escrito (o la ha instalado entre los dos renombrados,
+            # sin fcntl no hay bloqueo): nos quedamos con la suya
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    return meta
+
+# Modelo de sklearn de una versión. Solo hace falta para volver a calcular
+# artefactos que falten; al servir se usan los arrays planos
+def load_estimator(disease, version):
+    import joblib
+    return joblib.load(os.path.join(artifact_dir(disease, version), 'model.joblib'), mmap_mode='r')
+
+# Cargar un modelo ya entrenado (los arrays se mapean en memoria)
+def load_model_artifact(disease, version):
+    path = artifact_dir(disease, version)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    meta['population'] = load_population_stats(disease, version)
+    meta['forest'] = load_forest(disease, version)
+    meta['lookup'] = load_lookup(disease, version, meta['forest'])
+    meta['explainer'] = load_explainer(disease, version, meta['forest'])
+    meta['report'] = load_model_report(disease, version)
+    return meta
+
+# Registro de modelos: src/artifacts/<enfermedad>/CURRENT contiene la versión que se
+# sirve. Se reescribe de forma atómica (fichero temporal + os.replace), así que quien
+# lo lee siempre ve una versión completa, y cada worker lo consulta periódicamente
+# para cambiar de modelo sin reiniciarse (start_model_watcher)
+def current_path(disease):
+    return os.path.join(ARTIFACTS_DIR, disease, 'CURRENT')
+
+def read_current(disease):
+    try:
+        with open(current_path(disease)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+# Apuntar CURRENT a una versión ya entrenada (también sirve para volver a una anterior)
+def publish_version(disease, version):
+    if not os.path.isfile(os.path.join(artifact_dir(disease, version), 'meta.json')):
+        raise ValueError(f"{disease}: no hay ninguna versión {version} entrenada")
+    path = current_path(disease)
+    tmp_file = path + f'.tmp-{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        f.write(version + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+# Versión a servir: la de CURRENT o, si todavía no hay registro, la que corresponde a
+# los datos actuales (se entrena si falta y se publica)
+def serving_version(disease):
+    version = read_current(disease)
+    if version is None:
+        version = current_version(disease)
+        if not os.path.isfile(os.path.join(artifact_dir(disease, version), 'meta.json')):
+            train_and_save_model(disease)
+        publish_version(disease, version)
+    return version
+
+# Comprobar un modelo cargado con los pacientes de referencia antes de servirlo: las
+# probabilidades deben ser válidas y coincidir con las que dio al entrenar (los
+# artefactos anteriores al registro, sin ellas, se comparan con el recorrido del bosque)
+def validate_golden(model, tolerance=1e-9):
+    disease = model['disease']
+    if model['features'] != MODEL_SPECS[disease][1]:
+        raise ValueError(f"{disease} {model['version']}: variables {model['features']}, se esperaban {MODEL_SPECS[disease][1]}")
+    X = golden_inputs()[disease]
+    predicted = np.asarray(predict_risk(model, X), dtype=np.float64)
+    if not (np.isfinite(predicted).all() and ((predicted >= 0) & (predicted <= 1)).all()):
+        raise ValueError(f"{disease} {model['version']}: probabilidades no válidas para los pacientes de referencia")
+    expected = model.get('golden')
+    if expected is None:
+        expected = predict_proba_flat(model['forest'], X)
+    error = float(np.abs(predicted - np.asarray(expected)).max())
+    if error > tolerance:
+        raise ValueError(f"{disease} {model['version']}: los pacientes de referencia difieren en {error:.3g}")
+    return predicted
+
+# Cargar los modelos publicados en el registro
+def load_models():
+    models = {}
+    for disease in MODEL_SPECS:
+        models[disease] = load_model_artifact(disease, serving_version(disease))
+        validate_golden(models[disease])
+    return models
+
+# Modelos del proceso, cargados la primera vez que se piden. Cada cambio de versión
+# crea un dict nuevo y lo asigna de una vez, así que quien ya tiene el anterior
+# (una petición en curso) sigue con los mismos modelos hasta terminar
+_MODELS = None
+_MODELS_LOCK = threading.Lock()
+# Versiones que no pasaron validate_golden, para no volver a intentarlo en cada consulta
+_REJECTED = set()
+
+def get_models():
+    global _MODELS
+    models = _MODELS
+    if models is None:
+        with _MODELS_LOCK:
+            if _MODELS is None:
+                _MODELS = load_models()
+            models = _MODELS
+    return models
+
+# Cambiar a las versiones publicadas en CURRENT que aún no se sirven. Se cargan y se
+# comprueban fuera de las peticiones; 'prepare' recibe los modelos nuevos antes del
+# cambio (por ejemplo para construir sus figuras y que nadie espere por ellas).
+# Devuelve las enfermedades que han cambiado.
+def refresh_models(prepare=None, log=print):
+    global _MODELS
+    models = get_models()
+    updates = {}
+    for disease in MODEL_SPECS:
+        version = read_current(disease)
+        if version is None or version == models[disease]['version'] or (disease, version) in _REJECTED:
+            continue
+        try:
+            candidate = load_model_artifact(disease, version)
+            validate_golden(candidate)
+        except Exception as e:
+            _REJECTED.add((disease, version))
+            log(f"{disease}: versión {version} rechazada, se sigue sirviendo {models[disease]['version']} ({e})")
+            continue
+        updates[disease] = candidate
+    if not updates:
+        return []
+
+    new_models = {**models, **updates}
+    if prepare is not None:
+        prepare(new_models)
+    with _MODELS_LOCK:
+        _MODELS = new_models
+    for disease, model in updates.items():
+        log(f"{disease}: versión {models[disease]['version']} -> {model['version']} (accuracy={model['accuracy']:.4f})")
+    return list(updates)
+
+# Cada cuántos segundos consulta cada worker el registro (0 lo desactiva)
+MODEL_POLL_SECONDS = float(os.environ.get('APPHEALTH_MODEL_POLL', '30'))
+
+# Hilo que consulta el registro cada 'interval' segundos. Se arranca en cada worker
+# (gunicorn.conf.py), no en el maestro: los hilos no sobreviven al fork
+def start_model_watcher(prepare=None, log=print, interval=MODEL_POLL_SECONDS):
+    if interval <= 0:
+        return None
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                refresh_models(prepare, log)
+            except Exception as e:
+                log(f"Error al consultar el registro de modelos: {e}")
+    thread = threading.Thread(target=watch, name='model-watcher', daemon=True)
+    thread.start()
+    return thread
+
+# Búsqueda de hiperparámetros (python -m src.train --tune).
+# Cada candidato se entrena con la misma división que el modelo final y se mide
+# su accuracy, la latencia de puntuar un paciente y el tamaño del modelo serializado.
+DEFAULT_PARAMS = {'n_estimators': 100, 'max_depth': None, 'min_samples_leaf': 1}
+TUNING_CANDIDATES = (
+    [{'model': 'random_forest', 'params': {'n_estimators': n, 'max_depth': d, 'min_samples_leaf': leaf}}
+     for n in (25, 50, 100) for d in (None, 8, 12, 16) for leaf in (1, 5, 20)] +
+    [{'model': 'hist_gradient_boosting', 'params': {'max_iter': n, 'max_depth': d}}
+     for n in (50, 100) for d in (None, 6)]
+)
+# Solo los Random Forest se pueden servir con los arrays planos (predict_proba_flat)
+SERVABLE_MODELS = ('random_forest',)
+
+def candidate_key(candidate):
+    return json.dumps({'model': candidate['model'], 'params': candidate['params']}, sort_keys=True)
+
+# Hiperparámetros elegidos con --tune, por enfermedad. Es un fichero del repositorio (no
+# un artefacto) para que el entrenamiento del despliegue (render.yaml) use la elección;
+# el registro reanudable de la búsqueda sí queda en ARTIFACTS_DIR
+MODEL_PARAMS_PATH = 'src/model_params.json'
+
+def read_model_params():
+    try:
+        with open(MODEL_PARAMS_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+# Hiperparámetros elegidos para un modelo ({} = los de sklearn por defecto)
+def load_model_params(disease):
+    return read_model_params().get(disease, {}).get('params', {})
+
+def evaluate_candidate(disease, candidate, latency_rows=200):
+    from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
+    from sklearn.metrics import accuracy_score
+
+    target_column, features = MODEL_SPECS[disease]
+    X_train, X_test, y_train, y_test = split_data(load_dataset(disease), target_column, features)
+    X_train, X_test = X_train.to_numpy(), X_test.to_numpy()
+
+    if candidate['model'] == 'hist_gradient_boosting':
+        estimator = HistGradientBoostingClassifier(random_state=42, **candidate['params'])
+    else:
+        estimator = RandomForestClassifier(random_state=42, **candidate['params'])
+    start = time.perf_counter()
+    estimator.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - start
+    accuracy = accuracy_score(y_test, estimator.predict(X_test))
+
+    # Latencia de la ruta con la que se serviría: arrays planos para los bosques, sklearn para el resto
+    if candidate['model'] in SERVABLE_MODELS:
+        forest = export_forest(estimator)
+        score = lambda row: predict_proba_flat(forest, row)
+    else:
+        score = lambda row: estimator.predict_proba(row.reshape(1, -1))[0, 1]
+    rows = X_test[:latency_rows]
+    start = time.perf_counter()
+    for row in rows:
+        score(row)
+    latency_us = (time.perf_counter() - start) / len(rows) * 1e6
+
+    return dict(
+        candidate,
+        accuracy=float(accuracy),
+        latency_us=latency_us,
+        size_bytes=len(pickle.dumps(estimator)),
+        fit_seconds=fit_seconds
+    )
+
+# Candidatos no dominados: ningún otro es a la vez igual o mejor en accuracy,
+# latencia y tamaño, y estrictamente mejor en alguno
+def pareto_front(results):
+    def dominates(a, b):
+        no_worse = a['accuracy'] >= b['accuracy'] and a['latency_us'] <= b['latency_us'] and a['size_bytes'] <= b['size_bytes']
+        better = a['accuracy'] > b['accuracy'] or a['latency_us'] < b['latency_us'] or a['size_bytes'] < b['size_bytes']
+        return no_worse and better
+    return [r for r in results if not any(dominates(other, r) for other in results)]
+
+# Elegir, entre los candidatos servibles del frente de Pareto cuya accuracy no baja
+# más de 'tolerance' respecto al modelo actual, el más rápido (y después el más pequeño)
+def select_candidate(results, baseline_accuracy, tolerance):
+    eligible = [
+        r for r in results
+        if r['model'] in SERVABLE_MODELS and r['accuracy'] >= baseline_accuracy - tolerance
+    ]
+    return min(pareto_front(eligible), key=lambda r: (r['latency_us'], r['size_bytes']))
+
+# Búsqueda en paralelo y reanudable: cada resultado se añade a un fichero JSON lines
+# por versión de los datos, y al relanzarla solo se evalúan los candidatos que faltan
+def tune_model(disease, tolerance=0.005, n_jobs=None, log=print):
+    log_path = os.path.join(ARTIFACTS_DIR, disease, f'tuning-{data_hash(disease)[:12]}.jsonl')
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+
+    results = {}
+    if os.path.isfile(log_path):
+        with open(log_path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[candidate_key(result)] = result
+    pending = [c for c in TUNING_CANDIDATES if candidate_key(c) not in results]
+    log(f"{disease}: {len(results)} candidatos ya evaluados, {len(pending)} pendientes")
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool, open(log_path, 'a') as f:
+            futures = [pool.submit(evaluate_candidate, disease, candidate) for candidate in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                results[candidate_key(result)] = result
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+                log(f"  {result['model']} {result['params']}: accuracy={result['accuracy']:.4f} "
+                    f"latencia={result['latency_us']:.0f} us tamaño={result['size_bytes'] / 1e6:.1f} MB")
+
+    results = list(results.values())
+    baseline = next(r for r in results if r['model'] == 'random_forest' and r['params'] == DEFAULT_PARAMS)
+    selected = select_candidate(results, baseline['accuracy'], tolerance)
+
+    # Guardar la elección; los parámetros por defecto se guardan como {} para no cambiar la versión
+    params = {} if selected['params'] == DEFAULT_PARAMS else selected['params']
+    with file_lock(os.path.join(ARTIFACTS_DIR, 'model_params.lock')):
+        model_params = read_model_params()
+        model_params[disease] = {
+            'params': params,
+            'data_hash': data_hash(disease)[:12],
+            'tolerance': tolerance,
+            'selected': selected,
+            'baseline': baseline
+        }
+        tmp_file = MODEL_PARAMS_PATH + f'.tmp-{os.getpid()}'
+        with open(tmp_file, 'w') as f:
+            json.dump(model_params, f, indent=2, sort_keys=True)
+            f.write('\n')
+        os.replace(tmp_file, MODEL_PARAMS_PATH)
+    return selected, baseline
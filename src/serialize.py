@@ -0,0 +1,137 @@
+import base64
+import json
+import math
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # sin orjson se usa el módulo json
+    orjson = None
+
+# Serialización compacta de las figuras que se guardan en la caché (src.figure_cache):
+# - la plantilla de plotly se recorta a los tipos de traza que usa la figura (es más
+#   del 90% del JSON y el resto de tipos no influye en cómo se dibuja),
+# - los decimales de los datos se limitan según el tipo de gráfico (FIGURE_PRECISION),
+# - los arrays de enteros y los de floats sin límite de decimales se envían como typed
+#   arrays en base64 ({'dtype', 'bdata'}), que plotly.js entiende desde la 2.28,
+# - y el JSON se genera con orjson si está instalado.
+
+# Decimales de los datos por tipo de gráfico (primer elemento de la clave de la caché,
+# sin el sufijo ':enfermedad'); None conserva la precisión completa
+FIGURE_PRECISION = {
+    'feature_importance': 4,
+    'heatmap': 3,
+    'risk_diabetes': 4,
+    'risk_hypertension': 4,
+    'bmi_distribution': 2,
+    'age_distribution': 2,
+    'heart_rate_distribution': 2,
+    'gauge': 1
+}
+
+# Partes de la plantilla que solo usan ciertos tipos de traza
+SUBPLOT_TEMPLATES = {
+    'polar': {'scatterpolar', 'scatterpolargl', 'barpolar'},
+    'ternary': {'scatterternary'},
+    'scene': {'scatter3d', 'surface', 'mesh3d', 'cone', 'streamtube', 'isosurface', 'volume'},
+    'geo': {'scattergeo', 'choropleth'}
+}
+
+# Tipos de typed array de plotly.js
+TYPED_ARRAY_DTYPES = ('i1', 'u1', 'i2', 'u2', 'i4', 'u4', 'f4', 'f8')
+
+def figure_precision(chart):
+    return FIGURE_PRECISION.get(str(chart).split(':')[0])
+
+# Array de NumPy a partir de un typed array de plotly ({'dtype', 'bdata', 'shape'})
+def typed_array_values(value):
+    values = np.frombuffer(base64.b64decode(value['bdata']), dtype=value['dtype'])
+    shape = value.get('shape')
+    if shape:
+        values = values.reshape([int(n) for n in str(shape).split(',')])
+    return values
+
+def is_typed_array(value):
+    return isinstance(value, dict) and 'bdata' in value and value.get('dtype') in TYPED_ARRAY_DTYPES
+
+# Enteros en el tipo más pequeño que admite plotly.js; el resto como float64
+INTEGER_DTYPES = (np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32)
+
+def typed_array(values):
+    dtype = np.float64
+    if values.dtype.kind in 'iub':
+        low, high = int(values.min()), int(values.max())
+        dtype = next((t for t in INTEGER_DTYPES if np.iinfo(t).min <= low and high <= np.iinfo(t).max), np.float64)
+    values = np.ascontiguousarray(values, dtype=dtype)
+    encoded = {'dtype': values.dtype.str[1:], 'bdata': base64.b64encode(values.tobytes()).decode('ascii')}
+    if values.ndim > 1:
+        encoded['shape'] = ', '.join(str(n) for n in values.shape)
+    return encoded
+
+# Array numérico: enteros como typed array; floats redondeados a 'decimals' como lista
+# (con pocos decimales el texto ocupa menos que 8 bytes en base64) o, sin límite, como typed array
+def encode_array(values, decimals):
+    if values.dtype.kind in 'iub' and values.size:
+        return typed_array(values)
+    if values.dtype.kind != 'f':
+        return [encode_value(v, decimals) for v in values.tolist()]
+    if decimals is None:
+        return typed_array(values)
+    rounded = np.round(values, decimals)
+    return np.where(np.isfinite(rounded), rounded, None).tolist()
+
+def encode_value(value, decimals):
+    if isinstance(value, dict):
+        if is_typed_array(value):
+            return encode_array(typed_array_values(value), decimals)
+        return {key: encode_value(v, decimals) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v, decimals) for v in value]
+    if isinstance(value, np.ndarray):
+        return encode_array(value, decimals)
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return None
+        return value if decimals is None else round(value, decimals)
+    return value
+
+# Plantilla con solo lo que usan los tipos de traza de la figura
+def prune_template(template, trace_types):
+    template = dict(template)
+    if 'data' in template:
+        template['data'] = {name: value for name, value in template['data'].items() if name in trace_types}
+    if 'layout' in template:
+        template['layout'] = {
+            key: value for key, value in template['layout'].items()
+            if key not in SUBPLOT_TEMPLATES or SUBPLOT_TEMPLATES[key] & trace_types
+        }
+    return template
+
+# Figura de plotly como dict listo para JSON, con la plantilla recortada y los datos
+# limitados a 'decimals' (el layout conserva sus valores). Lee los dicts internos de la
+# figura sin copiarlos (to_plotly_json hace una copia profunda, plantilla incluida):
+# encode_value crea contenedores nuevos y nunca los modifica
+def figure_dict(fig, decimals=None):
+    data = [encode_value(trace, decimals) for trace in fig._data]
+    layout = encode_value({key: value for key, value in fig._layout.items() if key != 'template'}, None)
+    template = fig._layout.get('template')
+    if template is not None:
+        # La plantilla ya es JSON (cadenas, números y listas), no hace falta recorrerla
+        layout['template'] = prune_template(template, {trace.get('type', 'scatter') for trace in data})
+    return {'data': data, 'layout': layout}
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+def loads(serialized):
+    if orjson is not None:
+        return orjson.loads(serialized)
+    return json.loads(serialized)
+
+# JSON compacto de una figura para el tipo de gráfico 'chart'
+def figure_json(fig, chart=None):
+    return dumps(figure_dict(fig, figure_precision(chart)))
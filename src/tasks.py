@@ -0,0 +1,47 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Pool local de tareas pesadas (construir figuras de población, etc.) que agrupa
+# las peticiones iguales: si ya hay una tarea en curso con la misma clave, se
+# devuelve su Future en lugar de lanzar otra. La clave debe identificar el
+# resultado, por ejemplo (tipo de gráfico, versión de datos, versión de modelo).
+class TaskPool:
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.submitted = 0
+        self.coalesced = 0
+        self._reset()
+        # Tras un fork (workers de gunicorn con preload_app) los hilos del padre no
+        # existen en el hijo: cada proceso crea su propio pool
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._executor = None
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='apphealth-task')
+            future = self._executor.submit(fn, *args)
+            self._in_flight[key] = future
+            self.submitted += 1
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def run(self, key, fn, *args):
+        return self.submit(key, fn, *args).result()
+
+# Instancia única del proceso
+task_pool = TaskPool()
@@ -0,0 +1,85 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src.model import MODEL_SPECS, train_and_save_model, artifact_dir, current_version, tune_model, publish_version, read_current
+
+def print_stages(meta):
+    for stage in meta['training_stages']:
+        # Pico de la etapa y lo que ha crecido la memoria sobre la que tenía al empezar
+        memory = f", {stage['memory']} pico {stage['peak_mb']:.0f} MB (+{stage['peak_mb'] - stage['start_mb']:.0f} MB)"
+        print(f"  {stage['stage']:<11} {stage['seconds']:8.2f} s{memory}")
+
+# Apuntar el registro (CURRENT) a la versión indicada; los workers la cargan solos
+def publish(disease, version):
+    previous = read_current(disease)
+    if previous == version:
+        return
+    publish_version(disease, version)
+    print(f"{disease}: publicada la versión {version}" + (f" (antes {previous})" if previous else ""))
+
+# Punto de entrada para entrenar los modelos fuera del servidor web:
+#   python -m src.train [--force] [--jobs N] [--tune [--tolerance T]] [--no-publish] [diabetes hypertension]
+#   python -m src.train --publish VERSION enfermedad
+# Cada enfermedad se entrena en su propio proceso y cada bosque reparte
+# sus árboles entre los núcleos que le tocan. Al terminar se publica la versión
+# entrenada y los workers en marcha cambian a ella sin reiniciarse.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Entrena y guarda los modelos de AppHealth")
+    parser.add_argument('diseases', nargs='*', help=f"Modelos a entrenar ({', '.join(MODEL_SPECS)}); por defecto todos")
+    parser.add_argument('--force', action='store_true', help="Reentrenar aunque los datos no hayan cambiado")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help="Núcleos a usar en total")
+    parser.add_argument('--tune', action='store_true', help="Buscar antes hiperparámetros más ligeros con la misma accuracy")
+    parser.add_argument('--tolerance', type=float, default=0.005, help="Pérdida de accuracy admitida al elegir hiperparámetros")
+    parser.add_argument('--no-publish', action='store_true', help="Entrenar sin cambiar la versión que se sirve")
+    parser.add_argument('--publish', metavar='VERSION', help="Servir una versión ya entrenada (p. ej. volver a la anterior)")
+    args = parser.parse_args(argv)
+    for disease in args.diseases:
+        if disease not in MODEL_SPECS:
+            parser.error(f"modelo desconocido: {disease}")
+
+    if args.publish:
+        if len(args.diseases) != 1:
+            parser.error("--publish necesita exactamente una enfermedad")
+        try:
+            publish(args.diseases[0], args.publish)
+        except ValueError as e:
+            parser.error(str(e))
+        return
+
+    diseases = args.diseases or list(MODEL_SPECS)
+    if args.tune:
+        for disease in diseases:
+            selected, baseline = tune_model(disease, args.tolerance, args.jobs)
+            print(f"{disease}: elegido {selected['model']} {selected['params']} "
+                  f"(accuracy {selected['accuracy']:.4f} vs {baseline['accuracy']:.4f}, "
+                  f"latencia {selected['latency_us']:.0f} vs {baseline['latency_us']:.0f} us, "
+                  f"tamaño {selected['size_bytes'] / 1e6:.1f} vs {baseline['size_bytes'] / 1e6:.1f} MB)")
+
+    # Solo se reentrena una enfermedad si han cambiado sus datos o sus hiperparámetros
+    pending = []
+    for disease in diseases:
+        version = current_version(disease)
+        if not args.force and os.path.isdir(artifact_dir(disease, version)):
+            print(f"{disease}: versión {version} ya entrenada, se omite")
+            if not args.no_publish:
+                publish(disease, version)
+            continue
+        pending.append(disease)
+    if not pending:
+        return
+
+    n_jobs = max(1, args.jobs // len(pending))
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=len(pending)) as pool:
+        futures = [pool.submit(train_and_save_model, disease, args.force, n_jobs) for disease in pending]
+        for future in as_completed(futures):
+            meta = future.result()
+            print(f"{meta['disease']}: versión {meta['version']} guardada (accuracy={meta['accuracy']:.4f})")
+            print_stages(meta)
+            if not args.no_publish:
+                publish(meta['disease'], meta['version'])
+    print(f"Entrenamiento completo en {time.perf_counter() - start:.2f} s ({len(pending)} procesos x {n_jobs} núcleos)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import json
+import numpy as np
+import pytest
+import app
+from src import batch
+
+# Probabilidad con todos sus decimales: to_json la recortaría a 10
+PROBABILITY = 1 / 3
+
+# /api/score sin cargar los modelos: se puntúa siempre con PROBABILITY (y el diseño que
+# Dash valida en la primera petición no pinta los mapas de calor de los modelos)
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'get_models', lambda: {'diabetes': None, 'hypertension': None})
+    monkeypatch.setattr(app, 'importance_heatmap_graphs', lambda models: [])
+    monkeypatch.setattr(batch, 'predict_risk', lambda model, X: np.full(len(X), PROBABILITY))
+    return app.server.test_client()
+
+def post_csv(client, text):
+    return client.post('/api/score', data=text, content_type='text/csv')
+
+def test_csv_missing_columns(client):
+    response = post_csv(client, 'age,weight\n45,80\n')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == "Faltan columnas: bmi"
+
+def test_csv_empty(client):
+    response = post_csv(client, '')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+def test_csv_unparsable(client):
+    response = post_csv(client, 'age,bmi\n45,27.5\n50,31.0,3,1,2,extra\n')
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith("CSV no válido")
+
+def test_json_items_must_be_objects(client):
+    response = client.post('/api/score', json=[[45, 27.5]])
+    assert response.status_code == 400
+    assert response.get_json()['error'] == "Cada paciente debe ser un objeto JSON"
+
+def test_json_missing_columns(client):
+    response = client.post('/api/score', json=[{'age': 45}])
+    assert response.status_code == 400
+    assert response.get_json()['error'] == "Faltan columnas: bmi"
+
+def test_json_not_a_list(client):
+    response = client.post('/api/score', json={'age': 45, 'bmi': 27.5})
+    assert response.status_code == 400
+
+def test_json_empty_list(client):
+    response = client.post('/api/score', json=[])
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.get_data(as_text=True) == ''
+
+def test_ndjson_keeps_full_precision(client):
+    response = client.post('/api/score', json={'patients': [{'age': 45, 'bmi': 27.5}, {'age': 12, 'bmi': 20.0}]})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines[0]['diabetes_prob'] == PROBABILITY
+    assert lines[0]['hypertension_prob'] == PROBABILITY
+    assert lines[0]['health'] == 3
+    # Menor de 18: sin probabilidad
+    assert lines[1]['diabetes_prob'] is None
+
+def test_csv_scores_with_defaults(client):
+    response = post_csv(client, 'age,bmi\n45,27.5\n')
+    assert response.status_code == 200
+    header, row = response.get_data(as_text=True).splitlines()
+    assert header.split(',') == batch.OUTPUT_COLUMNS
+    assert float(row.split(',')[-1]) == PROBABILITY
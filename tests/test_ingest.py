@@ -0,0 +1,123 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from src import ingest
+
+PATIENT = {'age': 45, 'bmi': 27.5, 'health': 3, 'chest_pain': 1, 'pain': 2.3}
+
+# Cada prueba con su propio almacén de segmentos y sin estado de otra prueba
+@pytest.fixture(autouse=True)
+def segments_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, 'SEGMENTS_DIR', str(tmp_path / 'segments'))
+    monkeypatch.setattr(ingest, '_STATE', None)
+    return tmp_path / 'segments'
+
+def ingested_rows(state):
+    return {name: sketch['rows'] for name, sketch in state['sketch'].items()}
+
+def append(n):
+    return ingest.append_records([PATIENT] * n)
+
+# Estado calculado desde cero, como el de un proceso que acaba de arrancar
+def fresh_state():
+    return ingest.rebuild_state()
+
+def test_append_refresh_compact_refresh_counts_each_row_once():
+    first = append(2)
+    state = ingest.refresh_state()
+    assert state['segments'] == {first}
+    assert ingested_rows(state) == {'diabetes': 2, 'hypertension': 2}
+
+    second = append(3)
+    state = ingest.refresh_state()
+    assert state['segments'] == {first, second}
+    assert ingested_rows(state) == {'diabetes': 5, 'hypertension': 5}
+
+    compacted = ingest.compact()
+    state = ingest.refresh_state()
+    assert ingest.list_segments() == [compacted]
+    assert state['segments'] == {compacted}
+    assert ingested_rows(state) == {'diabetes': 5, 'hypertension': 5}
+    assert state['version'] == fresh_state()['version']
+
+    # Sin cambios, el estado es el mismo objeto
+    assert ingest.refresh_state() is state
+
+def test_compaction_seen_with_its_parts_still_listed():
+    first, second = append(1), append(2)
+    ingest.refresh_state()
+    # Compactación escrita pero sin borrar aún los segmentos que sustituye
+    parts = [ingest.load_segment(segment) for segment in (first, second)]
+    columns = {col: np.concatenate([np.asarray(part[col]) for part in parts]) for col in ingest.RECORD_COLUMNS}
+    compacted = ingest.write_segment(columns, replaces=[first, second])
+    state = ingest.refresh_state()
+    assert state['segments'] == {compacted}
+    assert ingested_rows(state) == {'diabetes': 3, 'hypertension': 3}
+
+def test_partial_replace_rebuilds_state(segments_dir, monkeypatch):
+    first, second = append(1), append(2)
+    ingest.refresh_state()
+    # Otro proceso escribe un segmento y compacta antes de que este lo sume: la
+    # compactación contiene un segmento sumado y otro que no
+    third = append(4)
+    parts = [ingest.load_segment(segment) for segment in (first, third)]
+    columns = {col: np.concatenate([np.asarray(part[col]) for part in parts]) for col in ingest.RECORD_COLUMNS}
+    compacted = ingest.write_segment(columns, replaces=[first, third])
+    for segment in (first, third):
+        shutil.rmtree(os.path.join(segments_dir, segment))
+
+    rebuilds = []
+    rebuild_state = ingest.rebuild_state
+    monkeypatch.setattr(ingest, 'rebuild_state', lambda: rebuilds.append(1) or rebuild_state())
+    state = ingest.refresh_state()
+    assert rebuilds == [1]
+    assert state['segments'] == {second, compacted}
+    assert ingested_rows(state) == {'diabetes': 7, 'hypertension': 7}
+
+def test_vanished_segment_rebuilds_state(segments_dir):
+    first, second = append(1), append(2)
+    ingest.refresh_state()
+    shutil.rmtree(os.path.join(segments_dir, first))
+    state = ingest.refresh_state()
+    assert state['segments'] == {second}
+    assert ingested_rows(state) == {'diabetes': 2, 'hypertension': 2}
+
+def test_invalid_records_are_not_stored():
+    assert ingest.append_records([dict(PATIENT, age=10), dict(PATIENT, bmi=None)]) is None
+    assert ingest.list_segments() == []
+
+def test_main_fills_form_defaults(tmp_path, capsys):
+    path = tmp_path / 'pacientes.csv'
+    path.write_text('age,bmi,health\n45,27.5,\n50,31.0,2\n12,20.0,3\n')
+    ingest.main([str(path)])
+    assert '2 pacientes añadidos, 1 descartados' in capsys.readouterr().out
+    columns = ingest.load_segment(ingest.list_segments()[0])
+    assert columns['health'].tolist() == [3, 2]
+    assert columns['pain'].tolist() == [3.0, 3.0]
+
+def test_main_reports_missing_columns(tmp_path):
+    path = tmp_path / 'pacientes.csv'
+    path.write_text('age,health\n45,3\n')
+    with pytest.raises(SystemExit, match='bmi'):
+        ingest.main([str(path)])
+
+# Volver a pulsar "Mostrar resultados" con los mismos datos no guarda otra vez al paciente
+def test_record_submission_once_per_distinct_submission(monkeypatch):
+    pending = []
+    monkeypatch.setattr(ingest, '_PENDING', pending)
+    record = dict(PATIENT, age_group=6, thalach=155.0, diabetes_prob=0.5, hypertension_prob=0.5)
+
+    assert ingest.record_submission(dict(record), None, []) is False
+    assert pending == []
+    assert ingest.record_submission(dict(record), dict(record, ingested=False), ['yes']) is True
+    assert len(pending) == 1
+    assert ingest.record_submission(dict(record), dict(record, ingested=True), ['yes']) is True
+    # Sin consentimiento sigue contando como guardado: no se vuelve a guardar al marcarlo
+    assert ingest.record_submission(dict(record), dict(record, ingested=True), []) is True
+    assert len(pending) == 1
+
+    changed = dict(record, bmi=31.0)
+    assert ingest.record_submission(changed, dict(record, ingested=True), ['yes']) is True
+    assert len(pending) == 2
+    assert pending[1]['bmi'] == 31.0
@@ -0,0 +1,98 @@
+from itertools import combinations
+from math import factorial
+import numpy as np
+import pytest
+from src import model as models
+from src.features import LOOKUP_GRIDS, golden_inputs
+
+# Contrato de la puntuación con los arrays planos, sobre un bosque pequeño entrenado con
+# datos sintéticos en la rejilla de diabetes (BMI, categoría de edad, salud general): el
+# recorrido plano da lo mismo que sklearn, la tabla de consulta lo mismo que el recorrido
+# bit a bit y las explicaciones son los valores de Shapley exactos
+
+DISEASE = 'diabetes'
+
+def patients(rng, n, on_grid):
+    bmi = rng.uniform(15, 45, n)
+    bmi = bmi.round(1) if on_grid else bmi.round(1) + 0.03
+    return np.column_stack([bmi, rng.integers(1, 14, n), rng.integers(1, 6, n)]).astype(np.float64)
+
+@pytest.fixture(scope='module')
+def fitted():
+    from sklearn.ensemble import RandomForestClassifier
+    rng = np.random.default_rng(0)
+    X = np.vstack([patients(rng, 1500, True), patients(rng, 500, False)])
+    logit = 0.15 * (X[:, 0] - 28) + 0.2 * (X[:, 1] - 7) + 0.5 * (X[:, 2] - 3)
+    y = (rng.random(len(X)) < 1 / (1 + np.exp(-logit))).astype(float)
+    rf = RandomForestClassifier(n_estimators=10, max_depth=8, min_samples_leaf=5, random_state=0)
+    rf.fit(X.astype(np.float32), y)
+    forest = models.export_forest(rf)
+    model = {
+        'forest': forest,
+        'lookup': models.build_lookup_table(DISEASE, forest),
+        'explainer': models.build_explainer(DISEASE, forest)
+    }
+    return rf, model
+
+@pytest.fixture
+def rows():
+    rng = np.random.default_rng(1)
+    return {'on_grid': patients(rng, 200, True), 'off_grid': patients(rng, 200, False)}
+
+def test_flat_forest_matches_sklearn(fitted, rows):
+    rf, model = fitted
+    for X in rows.values():
+        expected = rf.predict_proba(X.astype(np.float32))[:, 1]
+        assert np.abs(models.predict_proba_flat(model['forest'], X) - expected).max() <= 1e-9
+        # Un solo paciente (vector) por el mismo camino
+        assert abs(models.predict_proba_flat(model['forest'], X[0]) - expected[0]) <= 1e-9
+        # La comprobación que hace el entrenamiento
+        assert models.validate_forest(rf, model['forest'], X.astype(np.float32)) <= 1e-9
+
+def test_lookup_is_bit_for_bit(fitted, rows):
+    _, model = fitted
+    assert model['lookup']['grid'].tolist() == [list(axis) for axis in LOOKUP_GRIDS[DISEASE]]
+    models.validate_lookup(model['lookup'], model['forest'])
+    X = np.vstack([rows['on_grid'], rows['off_grid']])
+    _, on_grid = models.lookup_index(model['lookup']['grid'], X)
+    assert on_grid[:200].all() and not on_grid[200:].any()
+    assert np.array_equal(models.lookup_proba(model['lookup'], model['forest'], X),
+                          models.predict_proba_flat(model['forest'], X))
+
+# E[f(x) | x_S] recorriendo cada árbol: las variables de S siguen al paciente y las demás
+# reparten por la cobertura de cada hijo (la esperanza condicional de TreeSHAP)
+def expected_value(forest, x, subset):
+    feature, threshold, children = forest['feature'], forest['threshold'], forest['children']
+    cover, value = forest['cover'], forest['value']
+    def node_value(node):
+        left, right = children[node]
+        if left == node:
+            return value[node]
+        if feature[node] in subset:
+            return node_value(right if np.float32(x[feature[node]]) > threshold[node] else left)
+        return (cover[left] * node_value(left) + cover[right] * node_value(right)) / cover[node]
+    return np.mean([node_value(root) for root in forest['roots']])
+
+def brute_force_shapley(forest, x):
+    n = len(x)
+    phi = np.zeros(n)
+    for k in range(n):
+        others = [j for j in range(n) if j != k]
+        for size in range(n):
+            weight = factorial(size) * factorial(n - size - 1) / factorial(n)
+            for subset in combinations(others, size):
+                phi[k] += weight * (expected_value(forest, x, set(subset) | {k}) - expected_value(forest, x, set(subset)))
+    return phi
+
+def test_explanations_are_exact_shapley_values(fitted, rows):
+    _, model = fitted
+    X = np.vstack([rows['on_grid'], rows['off_grid']])
+    explainer = model['explainer']
+    models.validate_explainer(explainer, model['forest'], golden_inputs()[DISEASE])
+    contributions = models.explain_risk(model, X)
+    # Aditividad: la base más las contribuciones es la probabilidad del bosque
+    assert np.abs(explainer['base'] + contributions.sum(axis=1) - models.predict_proba_flat(model['forest'], X)).max() <= 1e-9
+    # La tabla por intervalos y las cajas de las hojas dan lo mismo
+    assert np.abs(contributions - models.explain_flat(explainer, X)).max() <= 1e-9
+    for x, phi in zip(X[::40], contributions[::40]):
+        assert np.abs(phi - brute_force_shapley(model['forest'], x)).max() <= 1e-9